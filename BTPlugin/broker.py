@@ -0,0 +1,385 @@
+# -*- encoding: utf-8 -*-
+
+__all__ = [
+    'Broker',
+    'BrokerServer',
+    'BrokerClient',
+    'BrokerError',
+    'build_pool',
+]
+
+import os
+import sys
+import json
+import base64
+import enum
+import socket
+import struct
+import logging
+import threading
+import socketserver
+from datetime import datetime, timedelta
+
+from . import sms, phonebook
+from .core import BTNearbyDevices
+from .exceptions import GsmModemException
+from .outbox import Outbox
+from .pool import Phone, PhonePool
+from .ratelimit import RateLimiter, parse_prefix_rates
+from .scheduler import Priority
+from .store import MessageStore
+
+# Processus unique propriétaire des connexions bluetooth,
+# interrogé par les workers web sur une socket locale
+
+# ----------------------------------------------------------
+
+# fonctions exécutées sur la connexion du téléphone : f(bt_client, *args, **kwargs)
+OPERATIONS = {
+    'sms.send_sms' : sms.send_sms,
+    'sms.send_sms_pdu' : sms.send_sms_pdu,
+    'sms.get_sms' : sms.get_sms,
+    'sms.store_sms' : sms.store_sms,
+    'sms.send_from_storage' : sms.send_from_storage,
+    'sms.send_to_many' : sms.send_to_many,
+    'sms.delete_sms' : sms.delete_sms,
+    'sms.delete_sms_list' : sms.delete_sms_list,
+    'sms.get_all_sms' : sms.get_all_sms,
+    'sms.get_all_sms_pdu' : sms.get_all_sms_pdu,
+    'phonebook.pbStorage' : phonebook.pbStorage,
+    'phonebook.pbRead' : phonebook.pbRead,
+    'phonebook.pbAdd' : phonebook.pbAdd,
+    'phonebook.pbUpdate' : phonebook.pbUpdate,
+    'phonebook.pbImport' : phonebook.pbImport,
+    'phonebook.pbExport' : phonebook.pbExport,
+}
+
+# méthodes de SMS exécutées sur la connexion du téléphone
+SMS_METHODS = {
+    'deviceInfo', 'countMessages', 'listMessages', 'syncMessages',
+    'deleteMessages', 'getMessage', 'sendMessage', 'storeMessage',
+    'broadcastMessage',
+}
+
+# méthodes exécutées en plusieurs pas (générateurs), entre lesquels
+# passent les tâches plus prioritaires
+SMS_JOBS = {
+    'listMessages' : 'listJob',
+    'syncMessages' : 'syncJob',
+    'deleteMessages' : 'deleteJob',
+}
+
+# opérations remplacées par leur variante en plusieurs pas
+OPERATION_JOBS = {
+    'phonebook.pbRead' : phonebook.pbReadJob,
+    'phonebook.pbImport' : phonebook.pbImportJob,
+    'phonebook.pbExport' : phonebook.pbExportJob,
+}
+
+# opérations de ménage : priorité par défaut après les envois et les synchronisations
+HOUSEKEEPING = {
+    'sms.delete_sms', 'sms.delete_sms_list', 'SMS.deleteMessages',
+}
+
+# ----------------------------------------------------------
+
+# Protocole : longueur (4 octets, big-endian) + document JSON compact
+
+class BrokerError(GsmModemException) :
+
+    def __init__(self, kind, message, retryable=False) :
+        super().__init__(f'{kind}: {message}')
+        self.kind = kind
+        self.retryable = retryable
+
+def _default(obj) :
+    if isinstance(obj, (bytes, bytearray)) :
+        return { '__bytes__' : base64.b64encode(obj).decode() }
+    if isinstance(obj, datetime) :
+        return { '__datetime__' : obj.isoformat() }
+    if isinstance(obj, timedelta) :
+        return { '__timedelta__' : obj.total_seconds() }
+    if isinstance(obj, enum.Enum) :
+        return obj.value
+    if isinstance(obj, Exception) :
+        return { '__error__' : obj.__class__.__name__, 'message' : str(obj) }
+    if isinstance(obj, (set, frozenset)) :
+        return list(obj)
+    # objets du décodage PDU (udh...)
+    return repr(obj)
+
+def _object_hook(obj) :
+    if '__bytes__' in obj :
+        return base64.b64decode(obj['__bytes__'])
+    if '__datetime__' in obj :
+        return datetime.fromisoformat(obj['__datetime__'])
+    if '__timedelta__' in obj :
+        return timedelta(seconds=obj['__timedelta__'])
+    return obj
+
+def encode_message(obj) :
+    payload = json.dumps(obj, default=_default, separators=(',', ':')).encode()
+    return struct.pack('>I', len(payload)) + payload
+
+def _recv_exactly(sock, size) :
+    data = b''
+    while len(data) < size :
+        chunk = sock.recv(size - len(data))
+        if chunk == b'' :
+            raise ConnectionError('broker connection closed')
+        data += chunk
+    return data
+
+def read_message(sock) :
+    size, = struct.unpack('>I', _recv_exactly(sock, 4))
+    return json.loads(_recv_exactly(sock, size), object_hook=_object_hook)
+
+def parse_address(address) :
+    # "/chemin/socket" (unix) ou "hôte:port" (tcp, si AF_UNIX indisponible)
+    host, sep, port = address.rpartition(':')
+    if sep != '' and port.isdigit() :
+        return socket.AF_INET, (host or '127.0.0.1', int(port))
+    return socket.AF_UNIX, address
+
+# ----------------------------------------------------------
+
+class Broker :
+
+    def __init__(self, pool, store=None, nearby=None) :
+        self._pool = pool
+        self._store = store
+        # services PBAP des téléphones, recherchés à la première lecture
+        self._nearby = nearby
+        self._pbap = dict()
+        # une seule lecture PBAP à la fois par téléphone, et dernier
+        # résultat gardé avec les compteurs du phonebook qui l'accompagnaient
+        self._pbap_lock = threading.Lock()
+        self._pbap_locks = dict()
+        self._pbap_cache = dict()
+
+    def _phone(self, name) :
+        phone = self._pool.phones[0] if name is None else self._pool.phone(name)
+        if phone is None :
+            raise BrokerError('UnknownPhone', name)
+        return phone
+
+    def _pbap_service(self, name) :
+        if name not in self._pbap :
+            if self._nearby is None :
+                self._nearby = BTNearbyDevices()
+            self._pbap[name] = self._nearby.service_pbap(name)
+        return self._pbap[name]
+
+    def pbap_entries(self, phone=None, name=None, counts=None, force=False) :
+        # phonebook complet en un transfert OBEX (PBAP), sur un canal distinct
+        # de la connexion AT : pas de tâche dans le CommandScheduler
+        # counts : compteurs du phonebook (AT+CPBS?) ; inchangés, le dernier
+        # transfert est renvoyé sans rouvrir de session
+        from .obex import PhoneBookClient, ObexError, PBAP_PHONEBOOK
+        phone = self._phone(phone)
+        name = name or PBAP_PHONEBOOK
+        counts = tuple(counts) if counts is not None else None
+        with self._pbap_lock :
+            lock = self._pbap_locks.setdefault(phone.name, threading.Lock())
+
+        with lock :
+            cached = self._pbap_cache.get((phone.name, name))
+            if not force and counts is not None and cached is not None and cached[0] == counts :
+                return cached[1]
+            try :
+                with PhoneBookClient(*self._pbap_service(phone.name)) as pbap :
+                    entries = list(pbap.entries(name))
+            except OSError :
+                # nouvelle recherche SDP au prochain essai
+                self._pbap.pop(phone.name, None)
+                raise
+            except ObexError as e :
+                raise BrokerError('ObexError', e) from e
+            if counts is not None :
+                self._pbap_cache[(phone.name, name)] = (counts, entries)
+            else :
+                self._pbap_cache.pop((phone.name, name), None)
+            return entries
+
+    def call(self, op, *args, phone=None, priority=None, **kwargs) :
+        if priority is None :
+            priority = Priority.HOUSEKEEPING if op in HOUSEKEEPING else Priority.INTERACTIVE
+
+        if op == 'pool.stats' :
+            limiter = self._pool.limiter
+            return {
+                'phones' : self._pool.stats(),
+                'rates' : limiter.stats() if limiter is not None else { 'phones' : dict(), 'prefixes' : dict() },
+            }
+        if op == 'pbap.entries' :
+            return self.pbap_entries(phone, *args, **kwargs)
+
+        if op in OPERATIONS :
+            function = OPERATION_JOBS.get(op, OPERATIONS[op])
+            job = lambda bt_client : function(bt_client, *args, **kwargs)
+        elif op.startswith('SMS.') and op[4:] in SMS_METHODS :
+            method = SMS_JOBS.get(op[4:], op[4:])
+            job = lambda bt_client : getattr(
+                sms.SMS(bt_client, store=self._store), method
+            )(*args, **kwargs)
+        else :
+            raise BrokerError('UnknownOperation', op)
+
+        return self._phone(phone).scheduler.submit(job, priority=priority).result()
+
+# ----------------------------------------------------------
+
+class BrokerHandler(socketserver.BaseRequestHandler) :
+
+    def handle(self) :
+        while True :
+            try :
+                request = read_message(self.request)
+            except (ConnectionError, struct.error) :
+                return
+
+            try :
+                result = self.server.broker.call(
+                    request['op'], *request.get('args', []),
+                    phone=request.get('phone'),
+                    priority=request.get('priority'),
+                    **request.get('kwargs', {})
+                )
+                response = { 'ok' : True, 'result' : result }
+            except Exception as e :
+                logging.debug(f'BrokerHandler: {request.get("op")} -> {e!r}')
+                response = {
+                    'ok' : False,
+                    'error' : e.__class__.__name__,
+                    'message' : str(e),
+                    'oserror' : isinstance(e, OSError),
+                    'retryable' : getattr(e, 'retryable', False),
+                }
+
+            self.request.sendall(encode_message(response))
+
+class BrokerServer(socketserver.ThreadingMixIn, socketserver.BaseServer) :
+
+    daemon_threads = True
+
+    def __init__(self, address, broker) :
+        self.address_family, server_address = parse_address(address)
+        if self.address_family == socket.AF_UNIX and os.path.exists(server_address) :
+            os.unlink(server_address)
+        self.socket = socket.socket(self.address_family, socket.SOCK_STREAM)
+        super().__init__(server_address, BrokerHandler)
+        self.broker = broker
+        self.socket.bind(self.server_address)
+        self.server_address = self.socket.getsockname()
+        self.socket.listen(16)
+
+    def fileno(self) :
+        return self.socket.fileno()
+
+    def get_request(self) :
+        return self.socket.accept()
+
+    def shutdown_request(self, request) :
+        try :
+            request.shutdown(socket.SHUT_WR)
+        except OSError :
+            pass
+        request.close()
+
+    def server_close(self) :
+        self.socket.close()
+
+# ----------------------------------------------------------
+
+class BrokerClient :
+
+    def __init__(self, address, timeout=120) :
+        self._address = address
+        self._timeout = timeout
+        # une connexion au broker par thread du worker web
+        self._local = threading.local()
+
+    def _socket(self) :
+        sock = getattr(self._local, 'sock', None)
+        if sock is None :
+            family, address = parse_address(self._address)
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            sock.settimeout(self._timeout)
+            sock.connect(address)
+            self._local.sock = sock
+        return sock
+
+    def close(self) :
+        sock = getattr(self._local, 'sock', None)
+        if sock is not None :
+            sock.close()
+        self._local.sock = None
+
+    def call(self, op, *args, phone=None, priority=None, **kwargs) :
+        request = {
+            'op' : op, 'args' : args, 'kwargs' : kwargs,
+            'phone' : phone, 'priority' : None if priority is None else int(priority),
+        }
+        try :
+            sock = self._socket()
+            sock.sendall(encode_message(request))
+            response = read_message(sock)
+        except OSError :
+            # connexion au broker perdue : nouvelle connexion au prochain appel
+            self.close()
+            raise
+
+        if response['ok'] :
+            return response['result']
+        if response['oserror'] :
+            raise ConnectionError(f'{response["error"]}: {response["message"]}')
+        raise BrokerError(response['error'], response['message'], response['retryable'])
+
+# ----------------------------------------------------------
+
+def build_pool(outbox, environ=os.environ, nearby=None) :
+    nearby = BTNearbyDevices() if nearby is None else nearby
+
+    bt_phone = environ.get('BT_PHONE', '<NO_PHONE>')
+    bt_phones = [
+        phone.strip()
+        for phone in environ.get('BT_PHONES', bt_phone).split(',')
+        if phone.strip() != ''
+    ]
+
+    def dialup_resolver(phone) :
+        return lambda : nearby.service_dialup(phone)
+
+    limiter = RateLimiter(
+        rate=float(environ.get('SMS_RATE', '0.1')),
+        burst=int(environ.get('SMS_BURST', '3')),
+        prefixes=parse_prefix_rates(environ.get('SMS_PREFIX_RATES', ''))
+    )
+
+    return PhonePool(
+        outbox,
+        [Phone(phone, dialup_resolver(phone)) for phone in bt_phones],
+        limiter=limiter
+    )
+
+def main() :
+    logging.basicConfig(level=os.environ.get('BT_BROKER_LOG', 'INFO'))
+    address = os.environ.get('BT_BROKER', '/tmp/flasksms.sock')
+
+    outbox = Outbox(os.environ.get('SMS_OUTBOX', 'outbox.db'))
+    store = MessageStore(os.environ.get('SMS_STORE', 'messages.db'))
+    pool = build_pool(outbox)
+    pool.start()
+
+    server = BrokerServer(address, Broker(pool, store))
+    logging.info(f'broker: listening on {server.server_address}')
+    try :
+        server.serve_forever()
+    except KeyboardInterrupt :
+        pass
+    finally :
+        server.server_close()
+        pool.stop()
+
+if __name__ == '__main__' :
+    sys.exit(main())
@@ -0,0 +1,245 @@
+# -*- encoding: utf-8 -*-
+
+__all__ = [
+    'ContactCache',
+    'ContactTrie',
+    'ContactIndex',
+    'normalize_number',
+    'storage_used',
+]
+
+import re
+import logging
+import threading
+import unicodedata
+
+# Cache du phonebook, indexé par numéro normalisé
+
+# ----------------------------------------------------------
+
+# type de numéro (TON/NPI) : 145 = international, 129 = national
+NUMTYPE_INTERNATIONAL = 145
+NUMTYPE_NATIONAL = 129
+
+RE_NUMBER_NOISE = re.compile(r'[\s.\-()/]')
+
+def normalize_number(number, numtype=None, country='33') :
+    # forme internationale "+33612345678" quand elle peut être déduite
+    if number is None :
+        return None
+    number = RE_NUMBER_NOISE.sub('', str(number))
+    if number.startswith('+') :
+        return number
+    if number.startswith('00') :
+        return '+' + number[2:]
+    if numtype is not None and int(numtype) == NUMTYPE_INTERNATIONAL :
+        return '+' + number
+    if number.startswith('0') and country is not None :
+        return f'+{country}{number[1:]}'
+    return number
+
+def number_suffix(number, size=9) :
+    # numéro significatif, pour les numéros dont le pays est inconnu
+    digits = ''.join(c for c in number if c.isdigit())
+    return digits[-size:] if len(digits) >= size else None
+
+def storage_used(storage_list) :
+    # +CPBS: "SM",<used>,<total> -> used (None si non fourni)
+    if len(storage_list) == 0 or len(storage_list[0]) < 3 :
+        return None
+    return int(storage_list[0][1])
+
+# ----------------------------------------------------------
+
+class ContactCache :
+
+    def __init__(self, country='33', suffix=9) :
+        self._country = country
+        self._suffix = suffix
+        self._lock = threading.Lock()
+        # storage -> { index : PhoneBookEntry }
+        self._entries = dict()
+        # storage -> nombre d'entrées lues sur le téléphone
+        self._used = dict()
+        # index en lecture seule, remplacés en bloc à chaque modification
+        self._numbers = dict()
+        self._suffixes = dict()
+        self._local_suffixes = dict()
+        self._listeners = []
+
+    def subscribe(self, callback) :
+        # callback() appelé après chaque modification du cache
+        self._listeners.append(callback)
+
+    def _changed(self) :
+        for callback in self._listeners :
+            callback()
+
+    @property
+    def country(self) :
+        return self._country
+
+    def normalize(self, number, numtype=None) :
+        return normalize_number(number, numtype, self._country)
+
+    def _reindex(self) :
+        numbers = dict()
+        suffixes = dict()
+        local_suffixes = dict()
+        for storage, entries in self._entries.items() :
+            for entry in entries.values() :
+                number = self.normalize(entry.number, entry.numtype)
+                if number is None or number == '' :
+                    continue
+                numbers.setdefault(number, entry)
+                suffix = number_suffix(number, self._suffix)
+                if suffix is not None :
+                    suffixes.setdefault(suffix, entry)
+                    if not number.startswith('+') :
+                        local_suffixes.setdefault(suffix, entry)
+        self._numbers = numbers
+        self._suffixes = suffixes
+        self._local_suffixes = local_suffixes
+
+    def fresh(self, storage, used) :
+        # même nombre d'entrées que lors de la dernière lecture
+        return self._used.get(storage) == used
+
+    def load(self, storage, entries, used=None) :
+        # lecture complète (éventuellement depuis le téléphone) hors du verrou
+        entries = { str(entry.index) : entry for entry in entries }
+        with self._lock :
+            self._entries[storage] = entries
+            self._used[storage] = len(entries) if used is None else used
+            self._reindex()
+        self._changed()
+        logging.debug(f'ContactCache.load: {storage} -> {len(entries)} entries')
+
+    def update(self, storage, entry) :
+        # entrée écrite par pbUpdate : pas besoin de relire le téléphone
+        with self._lock :
+            entries = self._entries.setdefault(storage, dict())
+            if str(entry.index) not in entries and storage in self._used :
+                self._used[storage] += 1
+            entries[str(entry.index)] = entry
+            self._reindex()
+        self._changed()
+
+    def remove(self, storage, index) :
+        with self._lock :
+            if self._entries.get(storage, dict()).pop(str(index), None) is None :
+                return
+            # storage jamais lu en entier (seulement update) : pas de compteur
+            if storage in self._used :
+                self._used[storage] -= 1
+            self._reindex()
+        self._changed()
+
+    def lookup(self, number, numtype=None) :
+        number = self.normalize(number, numtype)
+        if number is None :
+            return None
+        entry = self._numbers.get(number)
+        if entry is None :
+            # rapprochement sur la fin du numéro quand un des deux n'a pas de pays
+            suffix = number_suffix(number, self._suffix)
+            if suffix is not None :
+                suffixes = self._local_suffixes if number.startswith('+') else self._suffixes
+                entry = suffixes.get(suffix)
+        return entry
+
+    def name(self, number, numtype=None) :
+        entry = self.lookup(number, numtype)
+        return None if entry is None else entry.label
+
+    def decorate(self, records) :
+        # ajoute le nom du contact ('name') aux SMS listés
+        for record in records :
+            record['name'] = self.name(record.get('number'))
+        return records
+
+    def entries(self) :
+        return [
+            entry
+            for entries in list(self._entries.values())
+            for entry in list(entries.values())
+        ]
+
+    def __len__(self) :
+        return len(self._numbers)
+
+# ----------------------------------------------------------
+
+def fold(text) :
+    # minuscules sans accents, pour la recherche
+    text = unicodedata.normalize('NFKD', str(text).lower())
+    return ''.join(c for c in text if not unicodedata.combining(c))
+
+class ContactTrie :
+
+    def __init__(self, entries=(), country='33', k=10) :
+        # chaque noeud : [enfants, meilleures entrées (k au plus)]
+        self._root = [dict(), []]
+        self._country = country
+        self._k = k
+        for entry in sorted(entries, key=lambda entry : fold(entry.label or '')) :
+            for key in self.keys(entry) :
+                self._insert(key, entry)
+
+    def keys(self, entry) :
+        label = fold(entry.label or '')
+        keys = {label, *label.split()}
+        if entry.number :
+            number = normalize_number(entry.number, entry.numtype, self._country)
+            digits = RE_NUMBER_NOISE.sub('', str(entry.number))
+            keys.update((digits, number, number.lstrip('+')))
+            # forme nationale "06..." d'un numéro international du pays
+            if number.startswith(f'+{self._country}') :
+                keys.add('0' + number[len(self._country) + 1:])
+        keys.discard('')
+        return keys
+
+    def _insert(self, key, entry) :
+        # les entrées arrivent triées : les k premières de chaque noeud sont gardées
+        node = self._root
+        for c in key :
+            node = node[0].setdefault(c, [dict(), []])
+            if len(node[1]) < self._k and entry not in node[1] :
+                node[1].append(entry)
+
+    def complete(self, prefix, k=None) :
+        query = fold(prefix).strip()
+        # numéro saisi avec espaces, points ou tirets
+        number = RE_NUMBER_NOISE.sub('', query)
+        if number.lstrip('+').isdigit() :
+            query = number
+
+        node = self._root
+        for c in query :
+            node = node[0].get(c)
+            if node is None :
+                return []
+        return node[1][:k or self._k]
+
+class ContactIndex(threading.Thread) :
+
+    def __init__(self, cache, k=10) :
+        # trie reconstruit en arrière-plan à chaque modification du cache
+        super().__init__(name='ContactIndex', daemon=True)
+        self._cache = cache
+        self._k = k
+        self._trie = ContactTrie(k=k)
+        self._dirty = threading.Event()
+        cache.subscribe(self._dirty.set)
+
+    def complete(self, prefix, k=None) :
+        return self._trie.complete(prefix, k)
+
+    def run(self) :
+        while True :
+            self._dirty.wait()
+            self._dirty.clear()
+            trie = ContactTrie(self._cache.entries(), self._cache.country, self._k)
+            # remplacement en bloc : les recherches en cours gardent l'ancien
+            self._trie = trie
+            logging.debug(f'ContactIndex: rebuilt with {len(self._cache)} numbers')
@@ -5,16 +5,26 @@ __all__ = [
     'BTNearbyDevices',
     'BTServiceEnum',
     'BTClient',
+    'CircuitBreaker',
+    'circuit_breaker',
+    'BTLink',
 ]
 
+import re
 import sys
 import logging
 import enum
 import time
+import threading
+import contextlib
 from datetime import datetime
 
 import bluetooth
 
+from .exceptions import (
+    TimeoutException, CommandError, CmeError, CmsError, CircuitOpenError
+)
+
 # --------------------------------------------------------------------------
 
 def list_devices() :
@@ -178,7 +188,11 @@ class BTNearbyDevices(object) :
         return services
 
     def find_service(self, name, uuid=None) :
-        addr = self.get_addr_byname(name)
+        # on accepte aussi directement une adresse bluetooth
+        if bluetooth.is_valid_address(name) :
+            addr = name
+        else :
+            addr = self.get_addr_byname(name)
         if addr is None :
             return NO_BTSERVICE
         services = bluetooth.find_service(
@@ -203,6 +217,9 @@ class BTNearbyDevices(object) :
     def service_obextrans(self, name) :
         return self.find_service(name, uuid=BTServiceEnum.OBEX_FILETRANS)
 
+    def service_pbap(self, name) :
+        return self.find_service(name, uuid=BTServiceEnum.PHONEBOOK_ACCESS_PSE)
+
     @property
     def devices(self) :
         return self._devices
@@ -213,17 +230,140 @@ class BTNearbyDevices(object) :
 
 # --------------------------------------------------------------------------
 
+# Circuit breaker for unreachable devices
+
+class CircuitState(enum.StrEnum) :
+    CLOSED    = 'closed'
+    OPEN      = 'open'
+    HALF_OPEN = 'half-open'
+
+class CircuitBreaker :
+
+    def __init__(self, addr, threshold=3, cooldown=30, max_cooldown=600, resolver=None) :
+        self._addr = addr
+        # resolver() -> (addr, port) : service recherché à nouveau avant chaque sonde
+        self.resolver = resolver
+        self._threshold = threshold
+        self._cooldown = cooldown
+        self._max_cooldown = max_cooldown
+        self._delay = cooldown
+        self._failures = 0
+        self._state = CircuitState.CLOSED
+        self._opened_until = 0
+        self._service = None
+        self._prober = None
+        self._lock = threading.Lock()
+
+    @property
+    def addr(self) :
+        return self._addr
+
+    @property
+    def state(self) :
+        return self._state
+
+    def check(self) :
+        # échec immédiat tant que l'appareil est considéré injoignable
+        with self._lock :
+            if self._state != CircuitState.CLOSED :
+                raise CircuitOpenError(self._addr, max(0, self._opened_until - time.monotonic()))
+
+    def record_success(self) :
+        with self._lock :
+            self._failures = 0
+            self._delay = self._cooldown
+            self._state = CircuitState.CLOSED
+
+    def record_failure(self, service=None) :
+        with self._lock :
+            self._failures += 1
+            if service is not None :
+                self._service = service
+            if self._state == CircuitState.CLOSED and self._failures >= self._threshold :
+                self._open()
+
+    def _open(self) :
+        logging.debug(f'CircuitBreaker: {self._addr} open for {self._delay}s')
+        self._state = CircuitState.OPEN
+        self._opened_until = time.monotonic() + self._delay
+        # sonde en tâche de fond, les requêtes ne paient pas le délai de connexion
+        probe = self._service is not None or self.resolver is not None
+        if probe and (self._prober is None or not self._prober.is_alive()) :
+            self._prober = threading.Thread(
+                target=self._probe, name=f'CircuitBreaker-{self._addr}', daemon=True
+            )
+            self._prober.start()
+
+    def _probe(self) :
+        while True :
+            time.sleep(max(0, self._opened_until - time.monotonic()))
+            with self._lock :
+                self._state = CircuitState.HALF_OPEN
+                service = self._service
+
+            try :
+                if self.resolver is not None :
+                    # le téléphone a pu revenir à portée sur un autre canal
+                    service = self.resolver()
+                if service is None or service == NO_BTSERVICE :
+                    raise ConnectionError(f'{self._addr}: service not found')
+                sock = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
+                sock.connect(service)
+                sock.close()
+            except OSError as e :
+                logging.debug(f'CircuitBreaker: {self._addr} probe failed: {e}')
+                with self._lock :
+                    self._delay = min(self._delay * 2, self._max_cooldown)
+                    self._state = CircuitState.OPEN
+                    self._opened_until = time.monotonic() + self._delay
+                continue
+
+            self.record_success()
+            logging.debug(f'CircuitBreaker: {self._addr} closed')
+            return
+
+    def __repr__(self) :
+        return "{}(addr='{}', state='{}', failures={})".format(
+            self.__class__.__name__,
+            self._addr, self._state, self._failures
+        )
+
+CIRCUIT_BREAKERS = dict()
+CIRCUIT_BREAKERS_LOCK = threading.Lock()
+
+def circuit_breaker(addr, resolver=None) :
+    # addr : adresse bluetooth, ou nom du téléphone quand le service est recherché
+    with CIRCUIT_BREAKERS_LOCK :
+        if addr not in CIRCUIT_BREAKERS :
+            CIRCUIT_BREAKERS[addr] = CircuitBreaker(addr)
+        breaker = CIRCUIT_BREAKERS[addr]
+        if resolver is not None :
+            breaker.resolver = resolver
+        return breaker
+
+# --------------------------------------------------------------------------
+
 # Bluetooth Client for RFCOMM Service
 
 class BTClient(object) :
 
-    def __init__(self, service) :
+    def __init__(self, service, breaker=None) :
         self._service = service
         self._sock = None
+        self._breaker = circuit_breaker(service[0]) if breaker is None else breaker
+        # état du modem connu sur cette connexion (mode, storage...)
+        self.state = dict()
 
     def connect(self) :
+        self.state = dict()
+        self._breaker.check()
         self._sock = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
-        self._sock.connect(self._service)
+        try :
+            self._sock.connect(self._service)
+        except OSError :
+            self._breaker.record_failure(self._service)
+            raise
+        self._breaker.record_success()
         self._sock.settimeout(1)
 
     def __enter__(self) :
@@ -231,10 +371,20 @@ class BTClient(object) :
         return self
 
     def __exit__(self, *args) :
-        self._sock.close()
+        self.close()
 
     def close(self) :
-        self._sock.close()
+        if self._sock is not None :
+            self._sock.close()
+        self._sock = None
+
+    @property
+    def connected(self) :
+        return self._sock is not None
+
+    @property
+    def service(self) :
+        return self._service
 
     def _send(self, message, wait=1) :
         ret = self._sock.send(message + '\r\n')
@@ -258,10 +408,246 @@ class BTClient(object) :
         resp = self._recv(bufsize)
         return resp
 
+    def drain(self, bufsize=1024) :
+        # lit et jette la fin d'une réponse arrivée après le délai
+        return self._recv(bufsize)
+
+    def command(self, message, timeout=10, bufsize=64, check=True) :
+        # envoi puis lecture jusqu'au code résultat final (ou délai dépassé)
+        # check : lève l'exception correspondant à un résultat en erreur
+        deadline = time.monotonic() + timeout
+        response = b''
+        try :
+            self._send(message, wait=0)
+            while final_result(response) is None and time.monotonic() < deadline :
+                try :
+                    chunk = self._sock.recv(bufsize)
+                    logging.debug(f'command: chunk: {len(chunk)} <- {chunk}')
+                    response += chunk
+                except OSError as e :
+                    # simple délai de lecture : on continue d'attendre
+                    if not is_timeout(e) :
+                        raise
+        except OSError :
+            # socket morte : le téléphone n'est plus joignable
+            self._breaker.record_failure(self._service)
+            raise
+        logging.debug(f'command: {len(response)} <- {response}')
+        # réponse en retard sur une connexion vivante : pas un échec de connexion
+        if final_result(response) is not None :
+            self._breaker.record_success()
+        if check :
+            check_result(message, response)
+        return response
+
+    def prompt(self, message, timeout=5, bufsize=16) :
+        # commande suivie d'une saisie (AT+CMGS, AT+CMGW) : lecture jusqu'à
+        # l'invite "> ", ou jusqu'au code résultat qui est levé en erreur
+        deadline = time.monotonic() + timeout
+        response = b''
+        try :
+            self._send(message, wait=0)
+            while RE_PROMPT.search(response) is None and final_result(response) is None \
+                    and time.monotonic() < deadline :
+                try :
+                    response += self._sock.recv(bufsize)
+                except OSError as e :
+                    if not is_timeout(e) :
+                        raise
+            logging.debug(f'prompt: {len(response)} <- {response}')
+            if RE_PROMPT.search(response) is not None :
+                return response
+            if final_result(response) is None :
+                # pas d'invite : saisie annulée (ESC) avant toute autre commande
+                self._sock.send(chr(0x1b))
+                self._recv(bufsize)
+        except OSError :
+            self._breaker.record_failure(self._service)
+            raise
+        check_result(message, response)
+        # OK sans invite
+        raise CommandError(message)
+
     def ask(self, message, wait=1, bufsize=8, encoding='utf8') :
         print(self.send(message, wait, bufsize).decode(encoding, errors='replace'))
 
 
+# --------------------------------------------------------------------------
+
+# AT final result codes
+
+RE_FINAL_RESULT = re.compile(
+    rb'(?:^|\n)(OK|ERROR|\+CM([ES]) ERROR: ?([0-9]+))\r\n\Z'
+)
+
+# invite de saisie du PDU (AT+CMGS, AT+CMGW)
+RE_PROMPT = re.compile(rb'(?:^|\n)> ?\Z')
+
+def final_result(response) :
+    # ('OK', None), ('ERROR', None), ('CME', code), ('CMS', code) ou None
+    match = RE_FINAL_RESULT.search(response)
+    if match is None :
+        return None
+    result, kind, code = match.groups()
+    if kind is None :
+        return result.decode(), None
+    return f'CM{kind.decode()}', int(code)
+
+def check_result(command, response) :
+    result = final_result(response)
+    if result is None :
+        raise TimeoutException(command)
+    kind, code = result
+    if kind == 'CME' :
+        raise CmeError(command, code)
+    if kind == 'CMS' :
+        raise CmsError(command, code)
+    if kind == 'ERROR' :
+        raise CommandError(command)
+    return response
+
+def is_timeout(error) :
+    return isinstance(error, TimeoutError) or 'timed out' in str(error).lower()
+
+
+# --------------------------------------------------------------------------
+
+# Long-lived RFCOMM link with keepalive watchdog
+
+class BTLink(object) :
+
+    def __init__(self, service, idle=30, ping_timeout=3, name=None) :
+        # service : tuple (addr, port) ou fonction le résolvant (nouvelle
+        # recherche du canal lors d'une reconnexion)
+        self._service = service
+        # disjoncteur du téléphone (name), pas de l'adresse résolue : un téléphone
+        # hors de portée n'a pas d'adresse
+        self._breaker = circuit_breaker(
+            name if name is not None else service if callable(service) else service[0],
+            resolver=service if callable(service) else None
+        )
+        self._idle = idle
+        self._ping_timeout = ping_timeout
+        self._client = None
+        self._resolved = None
+        # la connexion doit être maintenue (après une première connexion)
+        self._wanted = False
+        self._lastused = time.monotonic()
+        self._lock = threading.RLock()
+        self._stop_event = threading.Event()
+        self._watchdog = None
+
+    def _resolve(self) :
+        service = self._service() if callable(self._service) else self._service
+        # service introuvable (téléphone hors de portée) : jamais gardé
+        self._resolved = None if service == NO_BTSERVICE else service
+        return service
+
+    def _open(self, service) :
+        if service == NO_BTSERVICE :
+            self._breaker.record_failure()
+            raise ConnectionError(f'{self._breaker.addr}: service not found')
+        client = BTClient(service, breaker=self._breaker)
+        client.connect()
+        return client
+
+    @property
+    def connected(self) :
+        return self._client is not None and self._client.connected
+
+    def connect(self) :
+        with self._lock :
+            self.close()
+            # échec immédiat tant que le disjoncteur est ouvert : sa sonde
+            # refait la recherche du service
+            self._breaker.check()
+            service = self._resolved or self._resolve()
+            try :
+                client = self._open(service)
+            except CircuitOpenError :
+                raise
+            except OSError :
+                # le canal RFCOMM a pu changer : nouvelle recherche du service
+                if not callable(self._service) :
+                    raise
+                resolved = self._resolve()
+                if resolved == service :
+                    raise
+                client = self._open(resolved)
+            self._client = client
+            self._wanted = True
+            self._lastused = time.monotonic()
+            logging.debug(f'BTLink: connected to {client.service}')
+
+    def close(self) :
+        with self._lock :
+            if self._client is not None :
+                try :
+                    self._client.close()
+                except OSError :
+                    pass
+            self._client = None
+
+    def ping(self) :
+        with self._lock :
+            if not self.connected :
+                return False
+            try :
+                self._client.command('AT', timeout=self._ping_timeout)
+            except (OSError, TimeoutException, CommandError) as e :
+                logging.debug(f'BTLink: ping failed: {e!r}')
+                return False
+            self._lastused = time.monotonic()
+            return True
+
+    @contextlib.contextmanager
+    def acquire(self) :
+        # usage exclusif de la connexion, rétablie si nécessaire
+        with self._lock :
+            if not self.connected :
+                self.connect()
+            try :
+                yield self._client
+            except OSError :
+                # socket mort : reconnexion à la prochaine utilisation
+                self.close()
+                raise
+            finally :
+                self._lastused = time.monotonic()
+
+    def start(self) :
+        if self._watchdog is None :
+            self._watchdog = threading.Thread(target=self._watch, name='BTLink', daemon=True)
+            self._watchdog.start()
+
+    def stop(self) :
+        self._stop_event.set()
+        self._wanted = False
+        self.close()
+
+    def _watch(self) :
+        while not self._stop_event.wait(1) :
+            if time.monotonic() - self._lastused < self._idle :
+                continue
+            # pas de vérification si la connexion est en cours d'utilisation
+            if not self._lock.acquire(blocking=False) :
+                continue
+            try :
+                if not self._wanted :
+                    continue
+                if not self.ping() :
+                    # reconnexion avant l'arrivée d'une vraie commande
+                    try :
+                        self.connect()
+                    except OSError as e :
+                        logging.debug(f'BTLink: reconnect failed: {e!r}')
+                        self.close()
+                        # nouvel essai après une autre période d'inactivité
+                        self._lastused = time.monotonic()
+            finally :
+                self._lock.release()
+
+
 def show_status(bt_client) :
     bt_client.ask('AT+CPMS?')
     bt_client.ask('AT+CMGF?')
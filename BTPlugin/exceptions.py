@@ -3,10 +3,15 @@
 class GsmModemException(Exception):
     """ Base exception raised for error conditions when interacting with the GSM modem """
 
+    # True if the same command may succeed when sent again later
+    retryable = False
+
 
 class TimeoutException(GsmModemException):
     """ Raised when a write command times out """
 
+    retryable = True
+
 
 class InvalidStateException(GsmModemException):
     """ Raised when an API method call is invoked on an object that is in an incorrect state """
@@ -22,6 +27,16 @@ class InterruptedException(InvalidStateException):
         self.cause = cause
 
 
+# (type, code) of errors reported while the SIM or modem is busy or not ready yet
+RETRYABLE_ERRORS = {
+    ('CME', 14),    # SIM busy
+    ('CME', 515),   # init or command processing in progress
+    ('CMS', 314),   # SIM busy
+    ('CMS', 332),   # network timeout
+    ('CMS', 515),   # init or command processing in progress
+}
+
+
 class CommandError(GsmModemException):
     """ Raised if the modem returns an error in response to an AT command
      
@@ -41,6 +56,10 @@ class CommandError(GsmModemException):
         else:
             super(CommandError, self).__init__()
 
+    @property
+    def retryable(self):
+        return (self.type, self.code) in RETRYABLE_ERRORS
+
 
 class CmeError(CommandError):
     """ ME error result code : +CME ERROR: <error>
@@ -127,3 +146,14 @@ class SmscNumberUnknownError(CmsError):
 
 class EncodingError(GsmModemException):
     """ Raised if a decoding- or encoding operation failed """
+
+
+class CircuitOpenError(ConnectionError):
+    """ Raised without trying to connect while a device is marked unreachable by its circuit breaker """
+
+    def __init__(self, addr, retry_in=None):
+        self.addr = addr
+        self.retry_in = retry_in
+        super(CircuitOpenError, self).__init__('{0} unreachable{1}'.format(
+            addr, ' (next probe in {0:.0f}s)'.format(retry_in) if retry_in is not None else ''
+        ))
@@ -0,0 +1,204 @@
+# -*- encoding: utf-8 -*-
+
+__all__ = [
+    'SyncDirection',
+    'FolderSync',
+]
+
+import os
+import sys
+import json
+import enum
+import time
+import logging
+import argparse
+
+from .obex import ObexSessionPool, normpath
+
+# Synchronisation incrémentale d'un dossier du téléphone (OBEX FTP)
+# avec un dossier local, à partir d'un manifeste des fichiers déjà copiés
+
+# ----------------------------------------------------------
+
+class SyncDirection(enum.StrEnum) :
+    PULL = 'pull'    # téléphone -> local
+    PUSH = 'push'    # local -> téléphone
+    BOTH = 'both'
+
+MANIFEST = '.obexsync.json'
+
+def remote_signature(entry) :
+    modified = entry.get('modified')
+    return [entry.get('size'), None if modified is None else modified.isoformat()]
+
+def local_signature(path) :
+    stat = os.stat(path)
+    return [stat.st_size, int(stat.st_mtime)]
+
+# ----------------------------------------------------------
+
+class FolderSync :
+
+    def __init__(self, sessions, phone, remote, local, manifest=MANIFEST) :
+        # sessions : ObexSessionPool, phone : nom du téléphone dans le pool
+        self._sessions = sessions
+        self._phone = phone
+        self._remote = normpath(remote)
+        self._local = local
+        self._manifest_path = os.path.join(local, manifest)
+        self._manifest = self._load()
+
+    def _load(self) :
+        # chemin relatif -> { 'remote' : [taille, date], 'local' : [taille, mtime] }
+        try :
+            with open(self._manifest_path, encoding='utf-8') as f :
+                return json.load(f)
+        except (OSError, ValueError) :
+            return dict()
+
+    def _save(self) :
+        # écrit après chaque fichier : une reprise ne refait que le fichier interrompu
+        temp = self._manifest_path + '.part'
+        with open(temp, 'w', encoding='utf-8') as f :
+            json.dump(self._manifest, f, indent=1, sort_keys=True)
+        os.replace(temp, self._manifest_path)
+
+    def _record(self, relpath, remote, local_path) :
+        self._manifest[relpath] = {
+            'remote' : remote,
+            'local' : local_signature(local_path),
+        }
+        self._save()
+
+    def _local_path(self, relpath) :
+        return os.path.join(self._local, *relpath.split('/'))
+
+    def _local_unchanged(self, relpath) :
+        known = self._manifest.get(relpath)
+        local_path = self._local_path(relpath)
+        return (
+            known is not None and os.path.exists(local_path)
+            and local_signature(local_path) == known['local']
+        )
+
+    def _pull(self, browser, report, keep_local=False) :
+        # keep_local : fichier modifié seulement en local, laissé à l'envoi
+        for path, dirs, files in browser.walk(self._remote) :
+            folder = path[len(self._remote):].strip('/')
+            for entry in files :
+                relpath = '/'.join(filter(None, [folder, entry['name']]))
+                remote = remote_signature(entry)
+                known = self._manifest.get(relpath)
+                if known is not None and known['remote'] == remote and (
+                    keep_local and os.path.exists(self._local_path(relpath))
+                    or self._local_unchanged(relpath)
+                ) :
+                    report['skipped'].add(relpath)
+                    continue
+
+                local_path = self._local_path(relpath)
+                os.makedirs(os.path.dirname(local_path), exist_ok=True)
+                if not browser.cd(path) :
+                    report['errors'].append((relpath, 'folder not found'))
+                    continue
+
+                # fichier complet ou rien : copie dans .part puis renommage
+                temp = local_path + '.part'
+                with open(temp, 'wb') as f :
+                    ok = browser.get_stream(entry['name'], f)
+                if not ok :
+                    os.remove(temp)
+                    report['errors'].append((relpath, 'get failed'))
+                    continue
+                os.replace(temp, local_path)
+                if entry.get('modified') is not None :
+                    stamp = entry['modified'].timestamp()
+                    os.utime(local_path, (stamp, stamp))
+
+                self._record(relpath, remote, local_path)
+                report['pulled'].append(relpath)
+
+    def _push(self, browser, report) :
+        for root, dirs, files in os.walk(self._local) :
+            folder = os.path.relpath(root, self._local).replace(os.sep, '/')
+            folder = '' if folder == '.' else folder
+            remote_folder = normpath(self._remote + '/' + folder)
+            pushed = []
+            for name in sorted(files) :
+                relpath = '/'.join(filter(None, [folder, name]))
+                if name.endswith('.part') or relpath == os.path.basename(self._manifest_path) :
+                    continue
+                if self._local_unchanged(relpath) :
+                    continue
+
+                if not browser.cd(remote_folder, create=True) :
+                    report['errors'].append((relpath, 'folder not created'))
+                    break
+                local_path = os.path.join(root, name)
+                with open(local_path, 'rb') as f :
+                    ok = browser.put_stream(name, f, os.path.getsize(local_path))
+                if not ok :
+                    report['errors'].append((relpath, 'put failed'))
+                    continue
+                pushed.append((relpath, name, local_path))
+
+            if len(pushed) == 0 :
+                continue
+
+            # signature distante relue une fois par dossier après les envois
+            entries = {
+                entry['name'] : entry
+                for entry in browser.listing(remote_folder) or []
+            }
+            for relpath, name, local_path in pushed :
+                entry = entries.get(name, { 'size' : os.path.getsize(local_path) })
+                self._record(relpath, remote_signature(entry), local_path)
+                report['pushed'].append(relpath)
+
+    def run(self, direction=SyncDirection.PULL, retries=3, delay=10) :
+        # reprise après une déconnexion : les fichiers terminés sont dans le manifeste
+        direction = SyncDirection(direction)
+        report = { 'pulled' : [], 'pushed' : [], 'skipped' : set(), 'errors' : [] }
+        os.makedirs(self._local, exist_ok=True)
+
+        for attempt in range(retries + 1) :
+            try :
+                with self._sessions.session(self._phone) as browser :
+                    # modifié des deux côtés : la version du téléphone l'emporte
+                    if direction in (SyncDirection.PULL, SyncDirection.BOTH) :
+                        self._pull(browser, report, keep_local=direction == SyncDirection.BOTH)
+                    if direction in (SyncDirection.PUSH, SyncDirection.BOTH) :
+                        self._push(browser, report)
+                report['skipped'] = len(report['skipped'])
+                return report
+            except OSError as e :
+                logging.warning(f'FolderSync: {self._phone} -> {e!r}, attempt {attempt + 1}')
+                if attempt == retries :
+                    raise
+                time.sleep(delay)
+
+# ----------------------------------------------------------
+
+def main() :
+    parser = argparse.ArgumentParser(description='OBEX folder sync')
+    parser.add_argument('phone')
+    parser.add_argument('remote')
+    parser.add_argument('local')
+    parser.add_argument('--direction', default='pull', choices=[d.value for d in SyncDirection])
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    sessions = ObexSessionPool()
+    try :
+        report = FolderSync(sessions, args.phone, args.remote, args.local).run(args.direction)
+    finally :
+        sessions.close()
+
+    print(f"pulled: {len(report['pulled'])}, pushed: {len(report['pushed'])}, "
+          f"skipped: {report['skipped']}, errors: {len(report['errors'])}")
+    for relpath, error in report['errors'] :
+        print(f'  {relpath}: {error}')
+    return 1 if len(report['errors']) > 0 else 0
+
+if __name__ == '__main__' :
+    sys.exit(main())
@@ -1,20 +1,139 @@
 # -*- encoding: utf-8 -*-
 
-from PyOBEX import client, responses
+import time
+import logging
+from datetime import datetime, timezone
+import threading
+import contextlib
+
+from PyOBEX import client, requests, responses, headers
 from lxml import etree
-from io import BytesIO
+
+from .vcard import read_vcards, vcard_entries
+
+class ObexError(Exception) :
+    # réponse d'échec du serveur OBEX : la session reste utilisable
+
+    def __init__(self, message, response=None) :
+        super().__init__(message)
+        self.response = response
+
+def read_body(cli, name, header_list=(), progress=None) :
+    # corps d'un GET au fil des paquets OBEX, sans tout accumuler
+    # progress(reçu, taille annoncée ou None) après chaque bloc
+    done = 0
+    total = None
+    for response in cli._get(name, list(header_list)) :
+        if not isinstance(response, (responses.Continue, responses.Success)) :
+            raise ObexError(f'OBEX: get {name} failed: {response}', response)
+        for header in response.header_data :
+            if isinstance(header, headers.Length) :
+                total = header.decode()
+            elif isinstance(header, (headers.Body, headers.End_Of_Body)) :
+                data = header.decode()
+                done += len(data)
+                yield data
+                if progress is not None :
+                    progress(done, total)
+
+def write_body(cli, name, file, size=None, progress=None, chunk=None) :
+    # PUT depuis un objet fichier, un paquet OBEX à la fois
+    max_length = cli.remote_info.max_packet_length
+    # en-tête du paquet (3 octets) et de l'en-tête Body (3 octets)
+    chunk = chunk or max_length - 6
+
+    header_list = [headers.Name(name)]
+    if size is not None :
+        header_list.append(headers.Length(size))
+    response = cli._send_headers(requests.Put(), header_list, max_length)
+    if not isinstance(response, responses.Continue) :
+        raise ObexError(f'OBEX: put {name} refused: {response}', response)
+
+    done = 0
+    data = file.read(chunk)
+    while True :
+        following = file.read(chunk) if data else b''
+        if following :
+            request = requests.Put()
+            request.add_header(headers.Body(data, False), max_length)
+        else :
+            request = requests.Put_Final()
+            request.add_header(headers.End_Of_Body(data, False), max_length)
+        cli.socket.sendall(request.encode())
+        response = cli.response_handler.decode(cli.socket)
+
+        done += len(data)
+        if progress is not None :
+            progress(done, size)
+        if not following :
+            break
+        if not isinstance(response, responses.Continue) :
+            raise ObexError(f'OBEX: put {name} interrupted: {response}', response)
+        data = following
+
+    if not isinstance(response, responses.Success) :
+        raise ObexError(f'OBEX: put {name} failed: {response}', response)
+
+def parse_time(value) :
+    # "20240131T235959Z" (UTC) ou "20240131T235959" (heure locale)
+    if value is None :
+        return None
+    try :
+        if value.endswith('Z') :
+            return datetime.strptime(value, '%Y%m%dT%H%M%SZ').replace(tzinfo=timezone.utc)
+        return datetime.strptime(value, '%Y%m%dT%H%M%S')
+    except ValueError :
+        return None
+
+def listing_entry(element) :
+    # <folder>/<file> -> dict des attributs, taille et dates converties
+    entry = dict(element.attrib)
+    entry['type'] = element.tag
+    entry['size'] = int(entry['size']) if entry.get('size', '').isdigit() else None
+    for attr in ('modified', 'created', 'accessed') :
+        entry[attr] = parse_time(entry.get(attr))
+    return entry
+
+def read_listing_events(parser) :
+    for event, element in parser.read_events() :
+        entry = listing_entry(element)
+        # élément traité et frères précédents libérés au fil de la lecture
+        element.clear()
+        while element.getprevious() is not None :
+            del element.getparent()[0]
+        yield entry
+
+def iter_listing(chunks) :
+    # folder-listing XML lu bloc par bloc, une entrée par <folder>/<file>/<parent-folder>
+    parser = etree.XMLPullParser(events=('end',), tag=('folder', 'file', 'parent-folder'))
+    for chunk in chunks :
+        parser.feed(chunk)
+        yield from read_listing_events(parser)
+    parser.close()
+    yield from read_listing_events(parser)
+
+def normpath(path) :
+    return '/' + '/'.join(part for part in path.split('/') if part not in ('', '.'))
 
 # use obextrans service
 
 class BrowserClient(object) :
 
-    def __init__(self, addr, port) :
+    def __init__(self, addr, port, max_age=60) :
         self._cli = None
         self._addr = addr
         self._port = port
+        # dossier distant courant, suivi pour éviter les setpath inutiles
+        self._path = []
+        # listings déjà lus : chemin -> (date, entrées)
+        self._listings = dict()
+        self._max_age = max_age
+        # GET ou PUT commencé et pas encore terminé
+        self._pending = False
         
     def connect(self) :
         if self._cli is None :
+            self._path = []
             try :
                 self._cli = client.BrowserClient(self._addr, self._port)
                 r = self._cli.connect()
@@ -33,6 +152,51 @@ class BrowserClient(object) :
                 pass
 
         self._cli = None
+        self._path = []
+        self._pending = False
+
+    @property
+    def connected(self) :
+        return self._cli is not None
+
+    @property
+    def pending(self) :
+        return self._pending
+
+    def abort(self) :
+        # annule le GET ou le PUT en cours ; sans réponse du serveur, la session est fermée
+        self._pending = False
+        try :
+            response = self._cli._send_headers(
+                requests.Abort(), [], self._cli.remote_info.max_packet_length
+            )
+        except OSError :
+            response = None
+
+        if not isinstance(response, responses.Success) :
+            logging.debug(f'abort: {response}, disconnecting')
+            self.disconnect()
+            return False
+        return True
+
+    def _read(self, name, header_list=(), progress=None) :
+        # GET abandonné avant la fin (client parti, erreur du lecteur) :
+        # l'opération est annulée pour que la session reste réutilisable
+        self._pending = True
+        try :
+            yield from read_body(self._cli, name, header_list, progress)
+            self._pending = False
+        except ObexError :
+            # échec renvoyé par le serveur : l'opération est déjà terminée
+            self._pending = False
+            raise
+        finally :
+            if self._pending :
+                self.abort()
+
+    @property
+    def path(self) :
+        return normpath('/'.join(self._path))
 
     def listdir(self) :
         response = self._cli.listdir()
@@ -41,35 +205,112 @@ class BrowserClient(object) :
             return { 'error' : 'failed to list directory', 'dirs' : None, 'files' : None }
 
         headers, data = response
-        
-        tree = etree.parse(BytesIO(data))
 
-        dirs = tree.xpath('//folder/@name')
-        if len(tree.xpath('//parent-folder')) > 0 :
+        dirs, files, parent = [], [], False
+        for entry in iter_listing([data]) :
+            if entry['type'] == 'folder' :
+                dirs.append(entry['name'])
+            elif entry['type'] == 'file' :
+                files.append(entry['name'])
+            else :
+                parent = True
+        if parent :
             dirs.append('..')
-        files = tree.xpath('//file/@name')
 
         return { 'dirs' : dirs, 'files' : files }
 
-    def chdir(self, name) :
+    def listing(self, path=None, refresh=False) :
+        # entrées (nom, type, taille, dates...) d'un dossier, depuis le cache si récent
+        path = self.path if path is None else normpath(path)
+        cached = self._listings.get(path)
+        if not refresh and cached is not None and time.monotonic() - cached[0] < self._max_age :
+            return cached[1]
+
+        if not self.cd(path) :
+            return None
+        # listing analysé au fil des paquets OBEX reçus
+        body = self._read('', [headers.Type(b'x-obex/folder-listing', False)])
+        try :
+            with contextlib.closing(body) :
+                entries = [
+                    entry for entry in iter_listing(body)
+                    if entry['type'] in ('folder', 'file')
+                ]
+        except ObexError as e :
+            logging.debug(f'listing: {path} -> {e}')
+            return None
+        self._listings[path] = time.monotonic(), entries
+        return entries
+
+    def invalidate(self, path=None) :
+        # dossier modifié (put, delete) : sa prochaine lecture ira sur le téléphone
+        self._listings.pop(self.path if path is None else normpath(path), None)
+
+    def walk(self, top='/') :
+        # comme os.walk : (chemin, dossiers, fichiers), en profondeur d'abord
+        # pour n'enchaîner que des setpath d'un niveau
+        entries = self.listing(top)
+        if entries is None :
+            return
+        top = normpath(top)
+        dirs = [entry for entry in entries if entry['type'] == 'folder']
+        files = [entry for entry in entries if entry['type'] == 'file']
+        yield top, dirs, files
+        for entry in dirs :
+            yield from self.walk(top.rstrip('/') + '/' + entry['name'])
+
+    def chdir(self, name, create=False) :
 
         if name == '..' :
             r = self._cli.setpath(to_parent=True)
+        elif name == '/' :
+            r = self._cli.setpath('')
+        elif create :
+            # dossier créé s'il n'existe pas : le listing du parent change
+            self.invalidate()
+            r = self._cli.setpath(name, create_dir=True)
         else :
             r = self._cli.setpath(name)
 
         if isinstance(r, responses.FailureResponse) :
             return False
 
+        if name == '..' :
+            self._path = self._path[:-1]
+        elif name == '/' :
+            self._path = []
+        else :
+            self._path.append(name)
+
+        return True
+
+    def cd(self, path, create=False) :
+        # chemin absolu, atteint avec le moins de setpath possible
+        target = [part for part in path.split('/') if part not in ('', '.')]
+        common = 0
+        while common < min(len(target), len(self._path)) and target[common] == self._path[common] :
+            common += 1
+
+        # remonter dossier par dossier, ou repartir de la racine
+        if len(self._path) - common > 1 + common :
+            steps = ['/'] + target
+        else :
+            steps = ['..'] * (len(self._path) - common) + target[common:]
+
+        for name in steps :
+            if not self.chdir(name, create=create and name not in ('/', '..')) :
+                return False
+
         return True
 
     def put(self, name, data) :
+        self.invalidate()
         response = self._cli.put(name, data)
 
         if isinstance(response, responses.Success) :
             return True
 
-        print(response)
+        logging.debug(f'put: {name} -> {response}')
         return False
         
     def get(self, name) :
@@ -80,14 +321,206 @@ class BrowserClient(object) :
 
         headers, data = response
 
-        for header in headers :
-            print(header)
         return data
 
+    def iter_get(self, name, progress=None) :
+        # blocs du fichier distant, dans le dossier courant
+        return self._read(name, progress=progress)
+
+    def get_stream(self, name, file, progress=None) :
+        # copie le fichier distant dans un objet fichier, bloc par bloc
+        try :
+            with contextlib.closing(self.iter_get(name, progress)) as chunks :
+                for data in chunks :
+                    file.write(data)
+        except ObexError as e :
+            logging.debug(f'get_stream: {e}')
+            return False
+
+        return True
+
+    def put_stream(self, name, file, size=None, progress=None) :
+        # envoie le contenu d'un objet fichier, bloc par bloc
+        self.invalidate()
+        # interrompu par une erreur de lecture du fichier : annulé par la session
+        self._pending = True
+        try :
+            write_body(self._cli, name, file, size, progress)
+        except ObexError as e :
+            logging.debug(f'put_stream: {e}')
+            self._pending = False
+            return False
+
+        self._pending = False
+        return True
+
     def delete(self, name) :
+        self.invalidate()
         response = self._cli.delete(name)
 
         if isinstance(response, responses.Success) :
             return True
 
         return False
+
+
+class ObexSessionPool(object) :
+
+    def __init__(self, resolver=None, idle=300) :
+        # resolver(name) -> (addr, port) du service OBEX FTP
+        self._resolver = resolver
+        self._idle = idle
+        self._services = dict()
+        self._sessions = dict()
+        self._locks = dict()
+        self._lock = threading.Lock()
+        self._watchdog = None
+        self._stop_event = threading.Event()
+
+    def _resolve(self, name) :
+        # la recherche SDP n'est refaite qu'après un échec de connexion
+        if name not in self._services :
+            if self._resolver is None :
+                from .core import BTNearbyDevices
+                self._resolver = BTNearbyDevices().service_obextrans
+            self._services[name] = self._resolver(name)
+        return self._services[name]
+
+    def _expire(self) :
+        now = time.monotonic()
+        for name, (browser, used) in list(self._sessions.items()) :
+            lock = self._locks[name]
+            if now - used > self._idle and lock.acquire(blocking=False) :
+                try :
+                    logging.debug(f'ObexSessionPool: {name} idle, closing')
+                    self.close(name)
+                finally :
+                    lock.release()
+
+    def start(self) :
+        # fermeture des sessions inactives même si aucune autre n'est demandée :
+        # le canal OBEX FTP du téléphone est libéré pour les autres processus
+        if self._watchdog is None :
+            self._watchdog = threading.Thread(target=self._watch, name='ObexSessionPool', daemon=True)
+            self._watchdog.start()
+
+    def stop(self) :
+        self._stop_event.set()
+        self.close()
+
+    def _watch(self) :
+        while not self._stop_event.wait(min(self._idle, 10)) :
+            with self._lock :
+                self._expire()
+
+    @contextlib.contextmanager
+    def session(self, name) :
+        # session OBEX ouverte et réutilisée, une opération à la fois par téléphone
+        with self._lock :
+            self._expire()
+            lock = self._locks.setdefault(name, threading.Lock())
+
+        with lock :
+            browser, used = self._sessions.get(name, (None, 0))
+            if browser is None or not browser.connected :
+                browser = BrowserClient(*self._resolve(name))
+                browser.connect()
+                if not browser.connected :
+                    self._services.pop(name, None)
+                    raise ConnectionError(f'OBEX: connection to {name} failed')
+                self._sessions[name] = browser, time.monotonic()
+
+            try :
+                yield browser
+            except OSError :
+                # session cassée : reconnexion à la prochaine utilisation
+                browser.disconnect()
+                self._sessions.pop(name, None)
+                raise
+            except BaseException :
+                # interrompue au milieu d'un transfert (GeneratorExit du
+                # téléchargement, erreur de l'appelant) : le serveur attend la suite
+                if browser.pending :
+                    browser.abort()
+                raise
+            finally :
+                if name in self._sessions :
+                    self._sessions[name] = browser, time.monotonic()
+
+    def close(self, name=None) :
+        names = list(self._sessions) if name is None else [name]
+        for name in names :
+            browser, used = self._sessions.pop(name, (None, 0))
+            if browser is not None :
+                browser.disconnect()
+
+
+# use phonebook access service (PBAP)
+
+# Target du service PBAP (PSE)
+PBAP_TARGET = b'\x79\x61\x35\xf0\xf0\xc5\x11\xd8\x09\x66\x08\x00\x20\x0c\x9a\x66'
+
+# objets du phonebook : contacts et historiques d'appels
+PBAP_PHONEBOOK = 'telecom/pb.vcf'
+PBAP_CALLS = 'telecom/cch.vcf'
+PBAP_INCOMING = 'telecom/ich.vcf'
+PBAP_OUTGOING = 'telecom/och.vcf'
+PBAP_MISSED = 'telecom/mch.vcf'
+
+def split_lines(chunks) :
+    # lignes complètes à partir des blocs reçus
+    pending = b''
+    for chunk in chunks :
+        pending += chunk
+        *lines, pending = pending.split(b'\n')
+        yield from lines
+    if pending != b'' :
+        yield pending
+
+class PhoneBookClient(object) :
+
+    def __init__(self, addr, port) :
+        self._cli = None
+        self._addr = addr
+        self._port = port
+
+    def connect(self) :
+        if self._cli is None :
+            try :
+                self._cli = client.Client(self._addr, self._port)
+                r = self._cli.connect(header_list=[headers.Target(PBAP_TARGET)])
+
+                if not isinstance(r, responses.ConnectSuccess) :
+                    self._cli = None
+
+            except OSError :
+                self._cli = None
+
+    def disconnect(self) :
+        if self._cli is not None :
+            try :
+                self._cli.disconnect()
+            except OSError :
+                pass
+
+        self._cli = None
+
+    def __enter__(self) :
+        self.connect()
+        if self._cli is None :
+            raise ConnectionError(f'PBAP: connection to {self._addr} failed')
+        return self
+
+    def __exit__(self, *args) :
+        self.disconnect()
+
+    def chunks(self, name=PBAP_PHONEBOOK) :
+        # corps de la réponse au fil des paquets OBEX, sans tout accumuler
+        return read_body(self._cli, name, [headers.Type(b'x-bt/phonebook')])
+
+    def vcards(self, name=PBAP_PHONEBOOK) :
+        return read_vcards(split_lines(self.chunks(name)))
+
+    def entries(self, name=PBAP_PHONEBOOK) :
+        # une PhoneBookEntry par numéro, index = rang de la vCard
+        return vcard_entries(self.vcards(name), indexed=True)
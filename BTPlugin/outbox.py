@@ -0,0 +1,241 @@
+# -*- encoding: utf-8 -*-
+
+__all__ = [
+    'OutboxStatus',
+    'Outbox',
+]
+
+import time
+import enum
+import logging
+import sqlite3
+import threading
+
+from . import sms
+from .exceptions import GsmModemException, CmsError, TimeoutException
+
+# File d'attente persistante des SMS à envoyer
+
+# ----------------------------------------------------------
+
+class OutboxStatus(enum.StrEnum) :
+    PENDING = 'pending'
+    SENDING = 'sending'
+    SENT    = 'sent'
+    FAILED  = 'failed'
+
+# ----------------------------------------------------------
+
+OUTBOX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id          INTEGER PRIMARY KEY AUTOINCREMENT,
+    numero      TEXT NOT NULL,
+    message     TEXT NOT NULL,
+    status      TEXT NOT NULL DEFAULT 'pending',
+    attempts    INTEGER NOT NULL DEFAULT 0,
+    next_try    REAL NOT NULL,
+    created     REAL NOT NULL,
+    updated     REAL NOT NULL,
+    response    TEXT,
+    error       TEXT,
+    phone       TEXT,
+    started     REAL,
+    waited      REAL
+);
+CREATE INDEX IF NOT EXISTS outbox_pending ON outbox (status, next_try);
+"""
+
+OUTBOX_COLUMNS = {
+    'phone' : 'TEXT',
+    'started' : 'REAL',
+    'waited' : 'REAL',
+}
+
+class Outbox :
+
+    def __init__(self, path='outbox.db', max_attempts=5, backoff=5, max_backoff=600, recover=True) :
+        # recover : faux pour un processus qui ne fait qu'alimenter la file
+        self._path = path
+        self._max_attempts = max_attempts
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._lock = threading.Lock()
+        # base partagée entre le broker et les workers web
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._db.row_factory = sqlite3.Row
+        with self._lock :
+            self._db.executescript(OUTBOX_SCHEMA)
+            # bases créées avant l'ajout de nouvelles colonnes
+            columns = [c['name'] for c in self._db.execute('PRAGMA table_info(outbox)')]
+            for column, kind in OUTBOX_COLUMNS.items() :
+                if column not in columns :
+                    self._db.execute(f'ALTER TABLE outbox ADD COLUMN {column} {kind}')
+            if recover :
+                # envois interrompus par un arrêt avant le modem : remis en file
+                self._db.execute(
+                    'UPDATE outbox SET status=? WHERE status=? AND started IS NULL',
+                    (OutboxStatus.PENDING, OutboxStatus.SENDING)
+                )
+                # PDU peut-être déjà transmis : un nouvel essai risquerait un doublon
+                self._db.execute(
+                    'UPDATE outbox SET status=?, error=?, updated=? WHERE status=?',
+                    (OutboxStatus.FAILED, 'interrupted (delivery unknown)', time.time(), OutboxStatus.SENDING)
+                )
+
+    @property
+    def path(self) :
+        return self._path
+
+    def enqueue(self, numero, message) :
+        now = time.time()
+        with self._lock :
+            cursor = self._db.execute(
+                'INSERT INTO outbox (numero, message, next_try, created, updated) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (numero, message, now, now, now)
+            )
+        logging.debug(f'enqueue: {cursor.lastrowid} -> {numero}')
+        return cursor.lastrowid
+
+    def claim(self) :
+        now = time.time()
+        with self._lock :
+            while True :
+                row = self._db.execute(
+                    'SELECT * FROM outbox WHERE status=? AND next_try<=? '
+                    'ORDER BY next_try, id LIMIT 1',
+                    (OutboxStatus.PENDING, now)
+                ).fetchone()
+                if row is None :
+                    return None
+                # base partagée entre processus : seul celui qui fait passer
+                # la ligne de 'pending' à 'sending' l'obtient
+                # started remis à zéro : il ne concerne que la tentative en cours
+                cursor = self._db.execute(
+                    'UPDATE outbox SET status=?, attempts=attempts+1, started=NULL, updated=? '
+                    'WHERE id=? AND status=?',
+                    (OutboxStatus.SENDING, now, row['id'], OutboxStatus.PENDING)
+                )
+                if cursor.rowcount == 1 :
+                    break
+        record = dict(row)
+        record.update(status=OutboxStatus.SENDING, attempts=record['attempts'] + 1, started=None)
+        return record
+
+    def assign(self, msg_id, phone) :
+        with self._lock :
+            self._db.execute(
+                'UPDATE outbox SET phone=?, updated=? WHERE id=?',
+                (phone, time.time(), msg_id)
+            )
+
+    def start(self, msg_id, waited=0) :
+        # début effectif de l'envoi, après l'attente éventuelle du limiteur
+        with self._lock :
+            self._db.execute(
+                'UPDATE outbox SET started=?, waited=? WHERE id=?',
+                (time.time(), waited, msg_id)
+            )
+
+    def complete(self, msg_id, responses) :
+        with self._lock :
+            self._db.execute(
+                'UPDATE outbox SET status=?, response=?, error=NULL, updated=? WHERE id=?',
+                (OutboxStatus.SENT, '\n'.join(responses), time.time(), msg_id)
+            )
+
+    def fail(self, msg_id, error, retryable=True) :
+        now = time.time()
+        with self._lock :
+            attempts, = self._db.execute(
+                'SELECT attempts FROM outbox WHERE id=?', (msg_id,)
+            ).fetchone()
+            if not retryable or attempts >= self._max_attempts :
+                status, next_try = OutboxStatus.FAILED, now
+            else :
+                # attente exponentielle entre deux tentatives
+                delay = min(self._backoff * 2 ** (attempts - 1), self._max_backoff)
+                status, next_try = OutboxStatus.PENDING, now + delay
+            self._db.execute(
+                'UPDATE outbox SET status=?, next_try=?, error=?, updated=? WHERE id=?',
+                (status, next_try, error, now, msg_id)
+            )
+        logging.debug(f'fail: {msg_id} [{attempts}] -> {status} : {error}')
+        return status
+
+    def get(self, msg_id) :
+        with self._lock :
+            row = self._db.execute(
+                'SELECT * FROM outbox WHERE id=?', (msg_id,)
+            ).fetchone()
+        return None if row is None else dict(row)
+
+    def list(self, limit=50) :
+        with self._lock :
+            rows = self._db.execute(
+                'SELECT * FROM outbox ORDER BY id DESC LIMIT ?', (limit,)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def wait_stats(self, limit=100) :
+        # temps d'attente en file (création -> envoi) des derniers messages
+        with self._lock :
+            row = self._db.execute(
+                'SELECT AVG(started - created), MAX(started - created), AVG(waited) '
+                'FROM (SELECT * FROM outbox WHERE started IS NOT NULL '
+                'ORDER BY id DESC LIMIT ?)',
+                (limit,)
+            ).fetchone()
+        queued, queued_max, waited = row
+        return {
+            'queued' : round(queued or 0, 2),
+            'queued_max' : round(queued_max or 0, 2),
+            'waited' : round(waited or 0, 2),
+        }
+
+    def close(self) :
+        with self._lock :
+            self._db.close()
+
+# ----------------------------------------------------------
+
+def throttle(limiter, phone, record) :
+    # attente du limiteur de débit, pour chaque morceau du message
+    if limiter is None :
+        return 0
+    parts = sms.count_parts(record['numero'], record['message'])
+    return limiter.acquire(phone, record['numero'], parts=parts)
+
+def deliver(outbox, service, record, limiter=None, phone=None, waited=0) :
+    # les jetons du limiteur sont pris avant (throttle), hors de la connexion :
+    # limiter ne sert ici qu'à ajuster le débit selon le résultat
+    numero = record['numero']
+    phone = sms.service_addr(service) if phone is None else phone
+    outbox.start(record['id'], waited)
+
+    try :
+        responses = sms.send_sms_pdu(
+            service,
+            numero=record['numero'],
+            message=record['message']
+        )
+    except (OSError, GsmModemException) as e :
+        if limiter is not None and isinstance(e, CmsError) :
+            limiter.record_error(phone, numero)
+        error = f'{e.__class__.__name__}: {e}'
+        accepted = getattr(e, 'accepted', 0)
+        if getattr(e, 'uncertain', isinstance(e, TimeoutException)) :
+            # réponse tardive ou message en partie envoyé : un nouvel essai
+            # risquerait un doublon chez le destinataire
+            retryable = False
+            error = f'{error} (delivery unknown, {accepted} part(s) accepted)'
+        else :
+            # connexion perdue ou modem occupé avant l'envoi : nouvel essai
+            # erreur définitive (numéro invalide, SMSC inconnu...) : pas de nouvel essai
+            retryable = isinstance(e, OSError) or e.retryable
+        return outbox.fail(record['id'], error, retryable=retryable), e
+
+    if limiter is not None :
+        limiter.record_success(phone, numero)
+    outbox.complete(record['id'], responses)
+    return OutboxStatus.SENT, None
@@ -2,18 +2,31 @@
 
 import re
 import csv
+import time
+import logging
 from collections import namedtuple
 
+from .sms import open_client, run_job
+from .exceptions import GsmModemException, CmeError, TimeoutException
+
 # Bluetooth access to PhoneBook
 
 PhoneBookEntry = namedtuple('PhoneBookEntry', ['index', 'number', 'numtype', 'label', 'flag'])
 
+def pbSelect(bt_client, storage) :
+    # storage déjà sélectionné sur cette connexion : pas de nouvel AT+CPBS
+    if storage is None or bt_client.state.get('pb_storage') == storage :
+        return
+    response = bt_client.send('AT+CPBS="{}"'.format(storage))
+    if b'OK' in response :
+        bt_client.state['pb_storage'] = storage
+    else :
+        bt_client.state.pop('pb_storage', None)
+
 def pbStorage(bt_client, storage=None) :
 
     # select storage before requesting properties
-    if storage is not None :
-        at_command = 'AT+CPBS="{}"'.format(storage)
-        bt_client.send(at_command)
+    pbSelect(bt_client, storage)
 
     at_command = 'AT+CPBS?'
     response = bt_client.send(at_command)
@@ -30,13 +43,14 @@ def pbRead(bt_client, start_index=1, stop_index=None, storage=None) :
 
     # choisir le storage du phonebook
     # "SM" = Carte SIM, "ME" = mémoire du téléphone
-    storage_list = pbStorage(bt_client, storage=storage)
+    pbStorage(bt_client, storage=storage)
 
     if stop_index is None :
         stop_index = start_index
 
     if stop_index == -1 :
-        stop_index = storage_list[0][2]
+        # tout le storage : lecture par pages
+        return list(pbIter(bt_client, start_index=start_index))
 
     at_command = 'AT+CPBR={},{}'.format(start_index, stop_index)
     response = bt_client.send(at_command)
@@ -50,19 +64,273 @@ def pbRead(bt_client, start_index=1, stop_index=None, storage=None) :
 
     return phonebook_list
 
+RE_CPBR = re.compile(r'\+CPBR:\s*(.+)\r\n')
+RE_CPBR_RANGE = re.compile(r'\+CPBR:\s*\(([0-9]+)-([0-9]+)\)')
 
-def pbAdd(bt_client, phonebook_entry) :
-    at_command = 'AT+CPBW=,"{r.number}",{r.numtype},"{r.label}",{r.flag}'.format(
-        r=phonebook_entry
+def pbEntries(response) :
+    # les champs absents (flag...) sont complétés par None
+    size = len(PhoneBookEntry._fields)
+    return [
+        PhoneBookEntry(*(entry + [None] * size)[:size])
+        for entry in csv.reader(RE_CPBR.findall(response.decode(errors='replace')))
+    ]
+
+def pbRange(bt_client, timeout=10) :
+    # (premier index, dernier index, nombre d'entrées ou None)
+    storage_list = pbStorage(bt_client)
+    if len(storage_list) > 0 and len(storage_list[0]) >= 3 :
+        return 1, int(storage_list[0][2]), int(storage_list[0][1])
+
+    # pas de compteurs dans +CPBS? : plage d'index donnée par AT+CPBR=?
+    response = bt_client.command('AT+CPBR=?', timeout=timeout)
+    first, last = RE_CPBR_RANGE.search(response.decode()).groups()
+    return int(first), int(last), None
+
+class PhoneBookPager :
+
+    def __init__(self, start_index=1, stop_index=None, storage=None,
+                 chunk=20, min_chunk=5, max_chunk=200, target=2, timeout=10) :
+        # lecture du phonebook par pages de taille adaptée au débit du téléphone,
+        # chaque page sur la connexion donnée (elle peut changer entre deux pages)
+        self._start_index = start_index
+        self._stop_index = stop_index
+        self._storage = storage
+        self._chunk = chunk
+        self._min_chunk = min_chunk
+        self._max_chunk = max_chunk
+        self._target = target
+        self._timeout = timeout
+        self._index = None
+        self._used = None
+        self._found = 0
+
+    def page(self, bt_client) :
+        # entrées de la page suivante, None une fois la plage lue
+        # une autre tâche a pu changer de storage depuis la page précédente
+        pbSelect(bt_client, self._storage)
+        if self._index is None :
+            first, last, self._used = pbRange(bt_client, timeout=self._timeout)
+            self._index = max(self._start_index, first)
+            self._stop_index = last if self._stop_index in (None, -1) else min(self._stop_index, last)
+
+        while self._index <= self._stop_index :
+            # toutes les entrées occupées sont lues : la fin est vide
+            if self._used is not None and self._found >= self._used :
+                break
+
+            index = self._index
+            page_stop = min(index + self._chunk - 1, self._stop_index)
+            started = time.monotonic()
+            try :
+                response = bt_client.command(
+                    f'AT+CPBR={index},{page_stop}', timeout=self._timeout, bufsize=1024
+                )
+            except TimeoutException :
+                # page trop longue : on jette la fin et on recommence plus petit
+                bt_client.drain()
+                if self._chunk <= self._min_chunk :
+                    raise
+                self._chunk = max(self._min_chunk, self._chunk // 2)
+                logging.debug(f'PhoneBookPager: timeout, chunk -> {self._chunk}')
+                continue
+            except CmeError as e :
+                # plage vide : "not found" ou "invalid index" selon le téléphone
+                if e.code not in (21, 22) :
+                    raise
+                response = b''
+            elapsed = time.monotonic() - started
+
+            entries = [
+                entry for entry in pbEntries(response)
+                if index <= int(entry.index) <= page_stop
+            ]
+            self._found += len(entries)
+
+            if len(entries) == 0 or elapsed < self._target / 2 :
+                self._chunk = min(self._max_chunk, self._chunk * 2)
+            elif elapsed > self._target :
+                self._chunk = max(self._min_chunk, self._chunk // 2)
+            self._index = page_stop + 1
+            return entries
+
+        return None
+
+def pbIter(service, start_index=1, stop_index=None, storage=None, **kwargs) :
+    # entrées rendues au fur et à mesure, sur une seule connexion
+    with open_client(service) as bt_client :
+        pager = PhoneBookPager(start_index, stop_index, storage, **kwargs)
+        while (entries := pager.page(bt_client)) is not None :
+            yield from entries
+
+def pbReadJob(bt_client, start_index=1, stop_index=None, storage=None) :
+    # pbRead pour CommandScheduler : rend la main entre deux pages
+    if stop_index != -1 :
+        return pbRead(bt_client, start_index, stop_index, storage)
+
+    pager = PhoneBookPager(start_index, storage=storage)
+    entries = []
+    while (page := pager.page(bt_client)) is not None :
+        entries.extend(page)
+        bt_client = yield
+    return entries
+
+
+def pbQuote(text) :
+    # chaîne AT : guillemets et antislash en \hh, pas de fin de ligne
+    text = '' if text is None else str(text)
+    text = re.sub(r'[\r\n]+', ' ', text)
+    return text.replace('\\', '\\5C').replace('"', '\\22')
+
+def pbNumber(number) :
+    return re.sub(r'[^0-9+*#pw]', '', '' if number is None else str(number))
+
+def pbNumtype(phonebook_entry) :
+    # 145 = international, 129 = national, déduit du numéro si absent
+    r = phonebook_entry
+    if r.numtype not in (None, '') :
+        return int(r.numtype)
+    return 145 if pbNumber(r.number).startswith('+') else 129
+
+def pbWriteCommand(phonebook_entry, index=None) :
+    # index None : le téléphone choisit un emplacement libre
+    r = phonebook_entry
+    at_command = 'AT+CPBW={},"{}",{},"{}"'.format(
+        '' if index is None else index, pbNumber(r.number), pbNumtype(r), pbQuote(r.label)
     )
+    if r.flag not in (None, '') :
+        at_command += ',{}'.format(r.flag)
+    return at_command
+
+def pbAdd(bt_client, phonebook_entry) :
+    at_command = pbWriteCommand(phonebook_entry)
     response = bt_client.send(at_command)
     
     return response.decode()
 
 def pbUpdate(bt_client, phonebook_entry) :
-    at_command = 'AT+CPBW={r.index},"{r.number}",{r.numtype},"{r.label}",{r.flag}'.format(
-        r=phonebook_entry
-    )
+    at_command = pbWriteCommand(phonebook_entry, phonebook_entry.index)
     response = bt_client.send(at_command)
 
     return response.decode()
+
+# ----------------------------------------------------------
+
+# Import / export en masse
+
+PhoneBookChange = namedtuple('PhoneBookChange', ['action', 'entry', 'error'])
+
+def pbKey(phonebook_entry) :
+    # contenu comparé : numéro, type et libellé
+    r = phonebook_entry
+    return pbNumber(r.number), pbNumtype(r), (r.label or '').strip()
+
+def pbSlot(phonebook_entry) :
+    # emplacement visé : index numérique, None sinon (CSV sans index, vCard PBAP "3.1")
+    index = str(phonebook_entry.index if phonebook_entry.index is not None else '').strip()
+    return index if index.isdigit() else None
+
+def pbDiff(current, wanted, delete=False) :
+    # liste des changements (action, entrée) pour passer de current à wanted
+    # les entrées voulues avec un emplacement visent celui-ci, les autres
+    # sont reconnues à leur contenu, puis à leur numéro (libellé modifié)
+    current = { str(entry.index) : entry for entry in current }
+    wanted = list(wanted)
+    kept = { pbSlot(entry) for entry in wanted if pbSlot(entry) is not None }
+    changes = [None] * len(wanted)
+
+    def match(key, position, action) :
+        for index, entry in current.items() :
+            if index not in kept and key(entry) == key(wanted[position]) :
+                kept.add(index)
+                if action != 'keep' :
+                    entry = wanted[position]._replace(index=index)
+                changes[position] = (action, entry)
+                return
+
+    for position, entry in enumerate(wanted) :
+        slot = pbSlot(entry)
+        if slot is None :
+            match(pbKey, position, 'keep')
+            continue
+        existing = current.get(slot)
+        if existing is not None and pbKey(existing) == pbKey(entry) :
+            changes[position] = ('keep', existing)
+        else :
+            changes[position] = ('update', entry._replace(index=slot))
+
+    for position, entry in enumerate(wanted) :
+        if changes[position] is None :
+            match(lambda entry : pbNumber(entry.number), position, 'update')
+        if changes[position] is None :
+            changes[position] = ('add', entry)
+
+    if delete :
+        # suppressions en premier : elles libèrent des emplacements
+        changes = [
+            ('delete', entry)
+            for index, entry in current.items() if index not in kept
+        ] + changes
+
+    return changes
+
+def pbImport(service, entries, storage=None, delete=False, dry_run=False, timeout=10) :
+    # écrit seulement les entrées modifiées, sur une seule connexion
+    with open_client(service) as bt_client :
+        return run_job(bt_client, pbImportJob(bt_client, entries, storage, delete, dry_run, timeout))
+
+def pbImportJob(bt_client, entries, storage=None, delete=False, dry_run=False, timeout=10) :
+    # tâche pour CommandScheduler : rend la main entre deux pages lues
+    # et après chaque écriture
+    entries = [
+        entry if isinstance(entry, PhoneBookEntry) else PhoneBookEntry(*entry)
+        for entry in entries
+    ]
+    current = yield from pbReadJob(bt_client, stop_index=-1, storage=storage)
+    bt_client = yield
+
+    results = []
+    for action, entry in pbDiff(current, entries, delete=delete) :
+        if action == 'keep' or dry_run :
+            results.append(PhoneBookChange(action, entry, None))
+            continue
+
+        if action == 'delete' :
+            at_command = 'AT+CPBW={}'.format(entry.index)
+        elif action == 'update' :
+            at_command = pbWriteCommand(entry, entry.index)
+        else :
+            at_command = pbWriteCommand(entry)
+
+        pbSelect(bt_client, storage)
+        try :
+            bt_client.command(at_command, timeout=timeout)
+            error = None
+        except GsmModemException as e :
+            logging.debug(f'pbImport: {at_command} -> {e!r}')
+            error = str(e)
+        results.append(PhoneBookChange(action, entry, error))
+        bt_client = yield
+
+    return results
+
+def pbExport(service, storage=None) :
+    # toutes les entrées du storage, lues par pages
+    with open_client(service) as bt_client :
+        return run_job(bt_client, pbExportJob(bt_client, storage))
+
+def pbExportJob(bt_client, storage=None) :
+    return (yield from pbReadJob(bt_client, stop_index=-1, storage=storage))
+
+def pbFromCsv(file) :
+    # colonnes : index (facultatif), number, numtype, label, flag
+    for row in csv.DictReader(file) :
+        yield PhoneBookEntry(
+            row.get('index') or None, row['number'], row.get('numtype') or None,
+            row.get('label', ''), row.get('flag') or None
+        )
+
+def pbToCsv(entries, file) :
+    writer = csv.writer(file)
+    writer.writerow(PhoneBookEntry._fields)
+    for entry in entries :
+        writer.writerow(entry)
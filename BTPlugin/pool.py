@@ -0,0 +1,234 @@
+# -*- encoding: utf-8 -*-
+
+__all__ = [
+    'Phone',
+    'PhoneWorker',
+    'PhonePool',
+]
+
+import time
+import queue
+import logging
+import threading
+
+from .core import BTLink
+from .scheduler import CommandScheduler, Priority
+from .outbox import OutboxStatus, deliver, throttle
+from .exceptions import CmsError, TimeoutException
+
+# Pool de téléphones pour l'envoi des SMS
+
+# ----------------------------------------------------------
+
+class Phone :
+
+    def __init__(self, name, service, latency=5.0, cooldown=60, smoothing=0.3, keepalive=30) :
+        self._name = name
+        # service : tuple (addr, port) ou fonction le résolvant au moment de l'envoi
+        self._service = service
+        # connexion maintenue entre deux envois, partagée par toutes les tâches
+        self.link = BTLink(service, idle=keepalive, name=name)
+        self.scheduler = CommandScheduler(self.link, name=f'CommandScheduler-{name}')
+        self._latency = latency
+        self._cooldown = cooldown
+        self._smoothing = smoothing
+        self._failures = 0
+        self._suspended_until = 0
+        self._sent = 0
+        self._lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.busy = False
+
+    @property
+    def name(self) :
+        return self._name
+
+    @property
+    def service(self) :
+        return self._service() if callable(self._service) else self._service
+
+    @property
+    def latency(self) :
+        return self._latency
+
+    @property
+    def depth(self) :
+        return self.queue.qsize() + int(self.busy)
+
+    @property
+    def available(self) :
+        return time.time() >= self._suspended_until
+
+    @property
+    def score(self) :
+        # temps estimé avant qu'un nouveau message soit envoyé par ce téléphone
+        return (self.depth + 1) * self._latency
+
+    def record_success(self, elapsed) :
+        with self._lock :
+            self._latency += self._smoothing * (elapsed - self._latency)
+            self._failures = 0
+            self._sent += 1
+
+    def record_failure(self) :
+        with self._lock :
+            self._failures += 1
+            # suspension de plus en plus longue tant que les échecs se répètent
+            delay = self._cooldown * 2 ** min(self._failures - 1, 5)
+            self._suspended_until = time.time() + delay
+        logging.debug(f'record_failure: {self._name} suspended for {delay}s')
+
+    def stats(self) :
+        return {
+            'name' : self._name,
+            'depth' : self.depth,
+            'latency' : round(self._latency, 2),
+            'sent' : self._sent,
+            'failures' : self._failures,
+            'available' : self.available,
+        }
+
+    def __repr__(self) :
+        return "{}(name='{}', depth={}, latency={:.2f})".format(
+            self.__class__.__name__,
+            self._name, self.depth, self._latency
+        )
+
+# ----------------------------------------------------------
+
+class PhoneWorker(threading.Thread) :
+
+    def __init__(self, outbox, phone, limiter=None) :
+        super().__init__(name=f'PhoneWorker-{phone.name}', daemon=True)
+        self._outbox = outbox
+        self._phone = phone
+        self._limiter = limiter
+        self._stop_event = threading.Event()
+
+    def stop(self) :
+        self._stop_event.set()
+
+    def run(self) :
+        while not self._stop_event.is_set() :
+            try :
+                record = self._phone.queue.get(timeout=1)
+            except queue.Empty :
+                continue
+            self._phone.busy = True
+            try :
+                self.process(record)
+            except Exception as e :
+                # message impossible à envoyer (encodage...) : écarté sans arrêter le worker
+                logging.exception(f'PhoneWorker: {record["id"]} -> {e!r}')
+                try :
+                    self._outbox.fail(record['id'], f'{e.__class__.__name__}: {e}', retryable=False)
+                except Exception as e :
+                    logging.error(f'PhoneWorker: {record["id"]} not marked failed: {e!r}')
+            finally :
+                self._phone.busy = False
+                self._phone.queue.task_done()
+
+    def process(self, record) :
+        # attente du limiteur avant de soumettre l'envoi : la connexion reste
+        # disponible pour les autres tâches pendant ce temps
+        waited = throttle(self._limiter, self._phone.name, record)
+        start = time.time()
+        try :
+            # les envois passent avant les synchronisations et le ménage
+            status, error = self._phone.scheduler.submit(
+                lambda bt_client : deliver(
+                    self._outbox, bt_client, record,
+                    limiter=self._limiter, phone=self._phone.name, waited=waited
+                ),
+                priority=Priority.INTERACTIVE
+            ).result()
+        except OSError as e :
+            # connexion impossible
+            status, error = self._outbox.fail(record['id'], f'{e.__class__.__name__}: {e}'), e
+
+        if isinstance(error, (OSError, TimeoutException)) :
+            # connexion perdue pendant l'envoi : elle sera rétablie
+            self._phone.link.close()
+
+        if status == OutboxStatus.SENT :
+            self._phone.record_success(time.time() - start)
+        elif isinstance(error, (OSError, CmsError)) or getattr(error, 'retryable', False) :
+            # connexion impossible, +CMS ERROR ou modem occupé : le téléphone est écarté un moment
+            self._phone.record_failure()
+        return status
+
+# ----------------------------------------------------------
+
+class PhonePool :
+
+    def __init__(self, outbox, phones, poll=1, max_depth=2, limiter=None) :
+        self._outbox = outbox
+        self._phones = list(phones)
+        # les messages restent dans l'outbox tant que les téléphones sont occupés
+        self._max_depth = max_depth
+        self._limiter = limiter
+        self._workers = [PhoneWorker(outbox, phone, limiter) for phone in self._phones]
+        self._poll = poll
+        self._stop_event = threading.Event()
+        self._dispatcher = threading.Thread(
+            target=self._dispatch, name='PhonePool', daemon=True
+        )
+
+    @property
+    def phones(self) :
+        return self._phones
+
+    def phone(self, name) :
+        for phone in self._phones :
+            if phone.name == name :
+                return phone
+        return None
+
+    def start(self) :
+        for phone in self._phones :
+            phone.link.start()
+            phone.scheduler.start()
+        for worker in self._workers :
+            worker.start()
+        self._dispatcher.start()
+
+    def stop(self) :
+        self._stop_event.set()
+        for worker in self._workers :
+            worker.stop()
+        for phone in self._phones :
+            phone.scheduler.stop()
+            phone.link.stop()
+
+    def select(self) :
+        candidates = [
+            phone
+            for phone in self._phones
+            if phone.available and phone.depth < self._max_depth
+        ]
+        if len(candidates) == 0 :
+            return None
+        return min(candidates, key=lambda phone : phone.score)
+
+    @property
+    def limiter(self) :
+        return self._limiter
+
+    def stats(self) :
+        return [phone.stats() for phone in self._phones]
+
+    def _dispatch(self) :
+        while not self._stop_event.is_set() :
+            phone = self.select()
+            if phone is None :
+                self._stop_event.wait(self._poll)
+                continue
+
+            record = self._outbox.claim()
+            if record is None :
+                self._stop_event.wait(self._poll)
+                continue
+
+            self._outbox.assign(record['id'], phone.name)
+            logging.debug(f'_dispatch: {record["id"]} -> {phone!r}')
+            phone.queue.put(record)
@@ -0,0 +1,138 @@
+# -*- encoding: utf-8 -*-
+
+__all__ = [
+    'TokenBucket',
+    'RateLimiter',
+]
+
+import time
+import logging
+import threading
+
+# Limitation du débit d'envoi des SMS
+
+# ----------------------------------------------------------
+
+class TokenBucket :
+
+    def __init__(self, rate, capacity=1, min_rate=None, max_rate=None) :
+        # rate : jetons par seconde, capacity : rafale autorisée
+        self._rate = rate
+        self._capacity = capacity
+        self._min_rate = rate / 8 if min_rate is None else min_rate
+        self._max_rate = rate * 4 if max_rate is None else max_rate
+        self._tokens = capacity
+        self._stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    @property
+    def rate(self) :
+        return self._rate
+
+    @rate.setter
+    def rate(self, rate) :
+        with self._lock :
+            self._refill()
+            self._rate = min(max(rate, self._min_rate), self._max_rate)
+
+    def _refill(self) :
+        now = time.monotonic()
+        self._tokens = min(self._capacity, self._tokens + (now - self._stamp) * self._rate)
+        self._stamp = now
+
+    def reserve(self, tokens=1) :
+        # réserve les jetons (quitte à s'endetter) et renvoie l'attente nécessaire
+        with self._lock :
+            self._refill()
+            needed = min(tokens, self._capacity)
+            delay = max(0, (needed - self._tokens) / self._rate)
+            self._tokens -= tokens
+        return delay
+
+    def acquire(self, tokens=1) :
+        delay = self.reserve(tokens)
+        if delay > 0 :
+            time.sleep(delay)
+        return delay
+
+    def __repr__(self) :
+        return "{}(rate={:.3f}, capacity={}, tokens={:.2f})".format(
+            self.__class__.__name__,
+            self._rate, self._capacity, self._tokens
+        )
+
+# ----------------------------------------------------------
+
+class RateLimiter :
+
+    def __init__(self, rate=0.1, burst=3, prefixes=None,
+                 increase=0.01, decrease=0.5) :
+        # débit par téléphone, et par préfixe de numéro destinataire
+        self._rate = rate
+        self._burst = burst
+        self._increase = increase
+        self._decrease = decrease
+        self._phones = dict()
+        self._prefixes = {
+            prefix : TokenBucket(prefix_rate, burst)
+            for prefix, prefix_rate in (prefixes or dict()).items()
+        }
+        self._lock = threading.Lock()
+
+    def phone_bucket(self, phone) :
+        with self._lock :
+            if phone not in self._phones :
+                self._phones[phone] = TokenBucket(self._rate, self._burst)
+            return self._phones[phone]
+
+    def prefix_bucket(self, numero) :
+        # préfixe le plus long correspondant au numéro
+        matches = [prefix for prefix in self._prefixes if numero.startswith(prefix)]
+        if len(matches) == 0 :
+            return None
+        return self._prefixes[max(matches, key=len)]
+
+    def buckets(self, phone, numero) :
+        buckets = [self.phone_bucket(phone)]
+        prefix_bucket = self.prefix_bucket(numero)
+        if prefix_bucket is not None :
+            buckets.append(prefix_bucket)
+        return buckets
+
+    def acquire(self, phone, numero, parts=1) :
+        delay = max(bucket.reserve(parts) for bucket in self.buckets(phone, numero))
+        if delay > 0 :
+            logging.debug(f'acquire: {phone} -> {numero} waits {delay:.2f}s')
+            time.sleep(delay)
+        return delay
+
+    def record_success(self, phone, numero) :
+        # augmentation additive du débit tant que tout va bien
+        for bucket in self.buckets(phone, numero) :
+            bucket.rate = bucket.rate + self._increase
+
+    def record_error(self, phone, numero) :
+        # réduction multiplicative du débit sur +CMS ERROR
+        for bucket in self.buckets(phone, numero) :
+            bucket.rate = bucket.rate * self._decrease
+        logging.debug(f'record_error: {phone} -> {numero} slowed down')
+
+    def stats(self) :
+        with self._lock :
+            phones = dict(self._phones)
+        return {
+            'phones' : { phone : round(bucket.rate, 3) for phone, bucket in phones.items() },
+            'prefixes' : { prefix : round(bucket.rate, 3) for prefix, bucket in self._prefixes.items() },
+        }
+
+# ----------------------------------------------------------
+
+def parse_prefix_rates(text) :
+    # "+33:0.5,06:0.2" -> {'+33': 0.5, '06': 0.2}
+    rates = dict()
+    for item in text.split(',') :
+        prefix, sep, rate = item.strip().rpartition(':')
+        if sep == '' or prefix == '' :
+            continue
+        rates[prefix] = float(rate)
+    return rates
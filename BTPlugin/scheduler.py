@@ -0,0 +1,102 @@
+# -*- encoding: utf-8 -*-
+
+__all__ = [
+    'Priority',
+    'CommandScheduler',
+]
+
+import enum
+import queue
+import inspect
+import logging
+import itertools
+import threading
+from concurrent.futures import Future
+
+# Ordonnancement des commandes envoyées à un téléphone
+
+# ----------------------------------------------------------
+
+class Priority(enum.IntEnum) :
+    INTERACTIVE  = 0
+    SYNC         = 1
+    HOUSEKEEPING = 2
+
+# ----------------------------------------------------------
+
+class Task :
+
+    def __init__(self, job, args, kwargs) :
+        self.job = job
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+        self._generator = None
+
+    def step(self, bt_client) :
+        # renvoie (terminé, résultat)
+        if self._generator is None :
+            result = self.job(bt_client, *self.args, **self.kwargs)
+            if not inspect.isgenerator(result) :
+                return True, result
+            self._generator = result
+            advance = lambda : next(self._generator)
+        else :
+            # la connexion courante est renvoyée au job à chaque reprise
+            advance = lambda : self._generator.send(bt_client)
+
+        try :
+            advance()
+        except StopIteration as e :
+            return True, e.value
+        return False, None
+
+# ----------------------------------------------------------
+
+class CommandScheduler(threading.Thread) :
+
+    def __init__(self, link, name='CommandScheduler') :
+        super().__init__(name=name, daemon=True)
+        # link : BTLink, seul accès au téléphone
+        self._link = link
+        self._queue = queue.PriorityQueue()
+        self._counter = itertools.count()
+        self._stop_event = threading.Event()
+
+    @property
+    def pending(self) :
+        return self._queue.qsize()
+
+    def submit(self, job, *args, priority=Priority.INTERACTIVE, **kwargs) :
+        # job(bt_client, *args, **kwargs) : fonction, ou générateur qui rend
+        # la main entre deux commandes (yield) pour laisser passer plus prioritaire
+        task = Task(job, args, kwargs)
+        self._queue.put((Priority(priority), next(self._counter), task))
+        return task.future
+
+    def stop(self) :
+        self._stop_event.set()
+
+    def run(self) :
+        while not self._stop_event.is_set() :
+            try :
+                priority, order, task = self._queue.get(timeout=1)
+            except queue.Empty :
+                continue
+
+            if not task.future.running() and not task.future.set_running_or_notify_cancel() :
+                continue
+
+            try :
+                with self._link.acquire() as bt_client :
+                    done, result = task.step(bt_client)
+            except Exception as e :
+                logging.debug(f'CommandScheduler: {task.job} -> {e!r}')
+                task.future.set_exception(e)
+                continue
+
+            if done :
+                task.future.set_result(result)
+            else :
+                # reprise plus tard, à son rang parmi les tâches de même priorité
+                self._queue.put((priority, order, task))
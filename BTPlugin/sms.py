@@ -1,19 +1,23 @@
 # -*- encoding: utf-8 -*-
 
 __all__ = [
-    'send_sms', 'send_sms_pdu',
+    'send_sms', 'send_sms_pdu', 'count_parts',
     'get_sms',
     'store_sms', 'store_draft_sms',
-    'send_from_storage',
-    'delete_sms'
+    'send_from_storage', 'send_to_many',
+    'delete_sms', 'delete_sms_list', 'delete_sms_flag'
 ]
 
 import re
 import logging
 import enum
+import time
 import collections
+import contextlib
+import datetime
 
 from .core import BTClient
+from .exceptions import GsmModemException, CommandError, CmsError, TimeoutException
 from .pdu import decodeSmsPdu, encodeSmsSubmitPdu
 
 # Bluetooth for sending SMS
@@ -41,33 +45,77 @@ class SMSFilter(IntAutoEnum) :
     def __init__(self, *args) :
         self.label = self.name.replace('_',' ')
 
+class SMSDeleteFlag(IntAutoEnum) :
+    INDEX            = ()
+    READ             = ()
+    READ_SENT        = ()
+    READ_SENT_UNSENT = ()
+    ALL              = ()
+
+# filtres de messages supprimés par chaque option de AT+CMGD
+DELETE_FLAG_FILTERS = {
+    SMSDeleteFlag.READ : { SMSFilter.REC_READ },
+    SMSDeleteFlag.READ_SENT : { SMSFilter.REC_READ, SMSFilter.STO_SENT },
+    SMSDeleteFlag.READ_SENT_UNSENT : { SMSFilter.REC_READ, SMSFilter.STO_SENT, SMSFilter.STO_UNSENT },
+    SMSDeleteFlag.ALL : { SMSFilter.REC_UNREAD, SMSFilter.REC_READ, SMSFilter.STO_SENT, SMSFilter.STO_UNSENT },
+}
+
+DeviceInfo = collections.namedtuple(
+    'DeviceInfo',
+    ['manufacturer', 'model', 'softwareVersion', 'imei', 'imsi', 'serviceCenter']
+)
+
+# identité des téléphones, par adresse bluetooth
+DEVICE_INFO_CACHE = dict()
+
 # ----------------------------------------------------------
 
 class SMS :
 
-    def __init__(self, service, encoding='utf-8') :
+    def __init__(self, service, encoding='utf-8', store=None) :
         self._service = service
         self._encoding = encoding
+        # connexion partagée pendant une session
+        self._client = None
+        # MessageStore optionnel : copie locale des messages du téléphone
+        self._store = store
+
+    # --- Session -------------------------------------------
+
+    @property
+    def _link(self) :
+        return self._service if self._client is None else self._client
+
+    @contextlib.contextmanager
+    def session(self) :
+        # sessions imbriquées : on garde la connexion déjà ouverte
+        if self._client is not None :
+            yield self
+            return
+
+        with open_client(self._service) as bt_client :
+            self._client = bt_client
+            try :
+                yield self
+            finally :
+                self._client = None
 
     # --- Properties ----------------------------------------
 
     @property
     def mode(self) :
-        response = b''
-        with BTClient(self._service) as bt_client :
-            response = bt_client.send('AT+CMGF?', wait=1, bufsize=32)
+        response = at_cmd(self._link, 'AT+CMGF?')
         mode, = parse_response(response)
         return SMSFormat(int(mode))
 
     @mode.setter
     def mode(self, mode) :
-        mode = SMSFormat(mode)
-        with BTClient(self._service) as bt_client :
-            bt_client.send(f'AT+CMGF={mode}', wait=1, bufsize=32)
+        with open_client(self._link) as bt_client :
+            set_sms_mode(bt_client, mode)
 
     @property
     def storage(self) :
-        response = at_cmd(self._service, 'AT+CPMS?')
+        response = at_cmd(self._link, 'AT+CPMS?')
         data, = parse_response(response)
         values = data.decode().split(',')
         storage = [(values[n].strip('"'), int(values[n+1]), int(values[n+2])) for n in range(0,len(values),3)]
@@ -75,11 +123,13 @@ class SMS :
 
     @storage.setter
     def storage(self, storage) :
-        at_cmd(self._service, f'AT+CPMS={storage}')
+        with open_client(self._link) as bt_client :
+            bt_client.state.pop('storage', None)
+            bt_client.send(f'AT+CPMS={storage}', wait=1, bufsize=32)
 
     @property
     def serviceCenter(self) :
-        response = get_smsc(self._service)
+        response = get_smsc(self._link)
         data, = parse_response(response)
         values = data.decode().split(',')
         ret = values[0].strip('"'), int(values[1])
@@ -87,73 +137,252 @@ class SMS :
 
     @property
     def phoneManufacturer(self) :
-        response = at_cmd(self._service, 'AT+CGMI')
+        response = at_cmd(self._link, 'AT+CGMI')
         ret = parse_response(response)
         return ret
 
     @property
     def phoneModel(self) :
-        response = at_cmd(self._service, 'AT+CGMM')
+        response = at_cmd(self._link, 'AT+CGMM')
         ret = parse_response(response)
         return ret
 
     @property
     def softwareVersion(self) :
-        response = at_cmd(self._service, 'AT+CGMR')
+        response = at_cmd(self._link, 'AT+CGMR')
         ret = parse_response(response)
         return ret
 
     @property
     def phoneIMEI(self) :
-        response = at_cmd(self._service, 'AT+CGSN')
+        response = at_cmd(self._link, 'AT+CGSN')
         ret = parse_response(response)
         return ret
 
     @property
     def phoneIMSI(self) :
-        response = at_cmd(self._service, 'AT+CIMI')
+        response = at_cmd(self._link, 'AT+CIMI')
         ret = parse_response(response)
         return ret
 
+    def deviceInfo(self, refresh=False) :
+        addr = service_addr(self._service)
+        if not refresh and addr in DEVICE_INFO_CACHE :
+            return DEVICE_INFO_CACHE[addr]
+
+        def first(values) :
+            return values[0].decode(self._encoding, errors='replace') if len(values) > 0 else None
+
+        # une seule connexion pour toutes les informations
+        with self.session() :
+            info = DeviceInfo(
+                manufacturer=first(self.phoneManufacturer),
+                model=first(self.phoneModel),
+                softwareVersion=first(self.softwareVersion),
+                imei=first(self.phoneIMEI),
+                imsi=first(self.phoneIMSI),
+                serviceCenter=self.serviceCenter
+            )
+
+        DEVICE_INFO_CACHE[addr] = info
+        return info
+
     # --- Methods --------------------------------------------
 
     def getMessage(self, index, storage='SM') :
-        ret = get_sms(self._service, index, encoding=self._encoding, storage=storage)
+        ret = get_sms(self._link, index, encoding=self._encoding, storage=storage)
         return ret        
 
     def sendMessage(self, numero, message) :
-        ret = send_sms_pdu(self._service, numero, message)
+        ret = send_sms_pdu(self._link, numero, message)
         return ret
 
     def storeMessage(self, numero, message, storage='SM', filter_by=SMSFilter.STO_UNSENT) :
-        ret = store_sms(self._service, numero, message, storage, filter_by)
+        ret = store_sms(self._link, numero, message, storage, filter_by)
+        return ret
+
+    def broadcastMessage(self, recipients, message, storage='SM', cleanup=True) :
+        ret = send_to_many(self._link, recipients, message, storage=storage, cleanup=cleanup)
         return ret
 
     def countMessages(self, storage='SM') :
         logging.debug(f'countMessages: storage={storage}')
-        cur_storage = self.storage
+        with self.session() :
+            cur_storage = self.storage
 
-        # a-t-on directement l'information ?
-        if cur_storage[0][0] == storage :
-            return cur_storage[0][1:]
+            # a-t-on directement l'information ?
+            if cur_storage[0][0] == storage :
+                return cur_storage[0][1:]
 
-        # on change de storage le temps de récupérer l'info
-        self.storage = f'"{storage}"'
-        count = self.storage[0][1:]
-        self.storage = f'"{cur_storage[0][0]}"'
+            # on change de storage le temps de récupérer l'info
+            self.storage = f'"{storage}"'
+            count = self.storage[0][1:]
+            self.storage = f'"{cur_storage[0][0]}"'
 
-        return count
+            return count
 
     def listMessages(self, retries=20, storage='SM', filter_by=SMSFilter.ALL) :
+        with self.session() :
+            return run_job(self._client, self.listJob(retries, storage, filter_by))
+
+    def listJob(self, retries=20, storage='SM', filter_by=SMSFilter.ALL) :
+        # tâche pour CommandScheduler : le comptage et la lecture du storage
+        # sont deux pas distincts
         logging.debug(f'listMessages: storage={storage}, filter_by={filter_by!r}')
-        ret = []
         # a-t-on des messages dans ce storage ?
         count, total = self.countMessages(storage=storage)
         logging.debug(f'listMessages: storage={storage}, count={count}, total={total}')
+        if count == 0 :
+            return []
+        self._client = yield
+
+        sms_data_pdu = get_all_sms_pdu(self._link, retries=retries, storage=storage, filter_by=filter_by)
+        return parse_messages_pdu(sms_data_pdu)
+
+    def syncMessages(self, retries=20, storage='SM', force=False, incremental=True, max_probes=10) :
+        with self.session() :
+            return run_job(self._client, self.syncJob(retries, storage, force, incremental, max_probes))
+
+    def syncJob(self, retries=20, storage='SM', force=False, incremental=True, max_probes=10) :
+        # tâche pour CommandScheduler : rend la main entre deux commandes,
+        # la connexion courante est renvoyée à chaque reprise
+        count, total = self.countMessages(storage=storage)
+        logging.debug(f'syncMessages: storage={storage}, count={count}, total={total}')
+
+        # le téléphone n'est relu que si les compteurs ont changé
+        stored_counts = self._store.counts(storage)
+        if not force and stored_counts == (count, total) :
+            return False
+        self._client = yield
+
+        # mode et storage ont pu être changés par une autre tâche entre-temps
+        set_sms_mode(self._link, SMSFormat.PDU)
+        set_sms_storage(self._link, storage_1=storage)
+        self._client = yield
+
+        if incremental and not force and stored_counts is not None :
+            records = yield from self._newRecords(storage, count, total, max_probes)
+            if records is not None :
+                self._store.update(storage, records, counts=(count, total))
+                return True
+            self._client = yield
+
+        # relecture complète du storage
+        records = []
         if count > 0 :
-            sms_data_pdu = get_all_sms_pdu(self._service, retries=retries, storage=storage, filter_by=filter_by)
-            ret = parse_messages_pdu(sms_data_pdu)
-        return ret
+            sms_data_pdu = get_all_sms_pdu(self._link, retries=retries, storage=storage)
+            records = [
+                decode_record(slot, filter_type, pdu)
+                for slot, filter_type, pdu in split_messages_pdu(sms_data_pdu)
+            ]
+        self._store.replace(storage, records, counts=(count, total))
+        return True
+
+    def _newRecords(self, storage, count, total, max_probes) :
+        known = self._store.slots(storage)
+        new = count - len(known)
+        logging.debug(f'_newRecords: storage={storage}, known={len(known)}, new={new}')
+
+        # des messages ont disparu : seule une relecture complète est fiable
+        if new <= 0 :
+            return None
+
+        # les nouveaux messages sont en général non lus
+        sms_data_pdu = get_all_sms_pdu(
+            self._link, retries=1, storage=storage, filter_by=SMSFilter.REC_UNREAD
+        )
+        records = [
+            decode_record(slot, filter_type, pdu)
+            for slot, filter_type, pdu in split_messages_pdu(sms_data_pdu)
+            if slot not in known
+        ]
+
+        # sinon lecture ciblée des slots inconnus, un AT+CMGR par reprise
+        if len(records) < new :
+            found = { r['slot'] for r in records }
+            candidates = [
+                slot
+                for slot in range(1, total + 1)
+                if slot not in known and slot not in found
+            ][:max_probes]
+            for candidate in candidates :
+                self._client = yield
+                set_sms_mode(self._link, SMSFormat.PDU)
+                set_sms_storage(self._link, storage_1=storage)
+                for slot, filter_type, pdu in read_slot_pdu(self._link, candidate) :
+                    records.append(decode_record(slot, filter_type, pdu))
+                if len(records) >= new :
+                    break
+
+            # revenir au storage "SM"
+            set_sms_storage(self._link, storage_1="SM")
+
+        # les compteurs ne concordent pas : relecture complète
+        if len(records) != new :
+            return None
+
+        return records
+
+    def deleteMessages(self, indexes=None, filter_by=None, older_than=None, where=None,
+                       storage='SM', retries=20) :
+        with self.session() :
+            return run_job(
+                self._client,
+                self.deleteJob(indexes, filter_by, older_than, where, storage, retries)
+            )
+
+    def deleteJob(self, indexes=None, filter_by=None, older_than=None, where=None,
+                  storage='SM', retries=20) :
+        # tâche pour CommandScheduler : rend la main après la sélection et chaque suppression
+        # filter_by : SMSFilter ou ensemble de SMSFilter
+        # older_than : datetime.timedelta, ou nombre de jours
+        # tout effacer demande filter_by=SMSFilter.ALL explicite
+        if indexes is None and filter_by is None and older_than is None and where is None :
+            raise ValueError('deleteMessages: no selection (use filter_by=SMSFilter.ALL to delete all)')
+        if isinstance(filter_by, SMSFilter) :
+            filter_by = { filter_by } if filter_by != SMSFilter.ALL else DELETE_FLAG_FILTERS[SMSDeleteFlag.ALL]
+        if isinstance(older_than, (int, float)) :
+            older_than = datetime.timedelta(days=older_than)
+
+        # suppression en une commande si le téléphone sait le faire
+        if indexes is None and older_than is None and where is None and filter_by is not None :
+            for flag, filters in DELETE_FLAG_FILTERS.items() :
+                if filters == set(filter_by) and flag in delete_flags(self._link) :
+                    response = delete_sms_flag(self._link, flag, storage=storage)
+                    if b'OK' in response :
+                        if self._store is not None :
+                            self._store.delete_filters(storage, filters)
+                        return response
+
+        # sinon sélection des slots, puis suppressions à la suite
+        if indexes is None :
+            self._client = yield
+            sms_data_pdu = get_all_sms_pdu(self._link, retries=retries, storage=storage)
+            records = [
+                decode_record(slot, filter_type, pdu)
+                for slot, filter_type, pdu in split_messages_pdu(sms_data_pdu)
+            ]
+            now = datetime.datetime.now(datetime.timezone.utc)
+            indexes = [
+                record['slot']
+                for record in records
+                if (filter_by is None or record['filter_type'] in filter_by)
+                and (older_than is None or (record['time'] is not None and now - record['time'] > older_than))
+                and (where is None or where(record))
+            ]
+
+        self._client = yield
+        responses = yield from delete_sms_job(self._link, indexes, storage=storage)
+
+        deleted = [index for index, response in responses.items() if b'OK' in response]
+        if self._store is not None :
+            self._store.delete(storage, deleted)
+
+        return responses
+
+    def storedMessages(self, storage='SM', filter_by=SMSFilter.ALL) :
+        records = self._store.records(storage, filter_by=filter_by)
+        return merge_records(records)
 
 # ----------------------------------------------------------
 
@@ -215,48 +444,131 @@ def parse_messages(messages_data) :
 
 # ----------------------------------------------------------
 
-def parse_messages_pdu(messages_data) :
+def split_messages_pdu(messages_data) :
 
-    messages = []
+    slots = []
     messages_list = parse_response(messages_data)
 
     for msg in messages_list :
         # scinder chaque message en header + body
         header, body = [x for x in msg.split(b'\r\n') if x != b'']
         slot, filter_type, _, _ = header.decode().split(',')
-        record = {
-            'slot' : int(slot),
-            'reference' : None,
-            'filter_type' : SMSFilter(int(filter_type)),
-            'parts' : 1,
-            'time' : None,
-            'validity' : None
-        }
-        record.update(decodeSmsPdu(body))
-        if 'udh' in record :
-            # indique un message composé
-            for udh in record['udh'] :
-                if udh.number == 1 :
-                    record.update({
-                        'reference' : udh.reference,
-                        'parts' : udh.parts
-                    })
-                    messages.append(record)
-                else :
-                    for message in filter(lambda x : x.get('reference',-1) == udh.reference, messages) :
-                        message['text'] += record.get('text')
-        else :
+        slots.append((int(slot), int(filter_type), body.decode()))
+
+    return slots
+
+# ----------------------------------------------------------
+
+def decode_record(slot, filter_type, pdu) :
+
+    record = {
+        'slot' : slot,
+        'reference' : None,
+        'filter_type' : SMSFilter(filter_type),
+        'part' : None,
+        'parts' : 1,
+        'time' : None,
+        'validity' : None,
+        'pdu' : pdu
+    }
+    record.update(decodeSmsPdu(pdu))
+    for udh in record.get('udh', []) :
+        # indique un message composé
+        if hasattr(udh, 'number') :
+            record.update({
+                'reference' : udh.reference,
+                'part' : udh.number,
+                'parts' : udh.parts
+            })
+
+    return record
+
+# ----------------------------------------------------------
+
+def merge_records(records) :
+
+    messages = []
+
+    for record in records :
+        if record['part'] is None :
             # message simple
             messages.append(record)
+        elif record['part'] == 1 :
+            # premier morceau d'un message composé
+            messages.append(record)
+        else :
+            # morceaux suivants (on complète le message avec cette référence)
+            for message in filter(
+                lambda x : x['part'] is not None and x['reference'] == record['reference'],
+                messages
+            ) :
+                message['text'] += record.get('text')
 
     return messages
 
 # ----------------------------------------------------------
 
+def parse_messages_pdu(messages_data) :
+
+    records = [
+        decode_record(slot, filter_type, pdu)
+        for slot, filter_type, pdu in split_messages_pdu(messages_data)
+    ]
+
+    return merge_records(records)
+
+# ----------------------------------------------------------
+
+RE_CMGL = re.compile(rb'\+CMGL: ?([0-9]+)')
+
+def command_with_retry(bt_client, at_command, retries=10, deadline=30, timeout=10, backoff=0.5) :
+    # nouvel essai uniquement si le modem est occupé ou ne répond pas,
+    # avec une attente exponentielle et une durée totale bornée
+    start = time.monotonic()
+    delay = backoff
+    for attempt in range(retries) :
+        remaining = deadline - (time.monotonic() - start)
+        try :
+            return bt_client.command(at_command, timeout=min(timeout, max(remaining, 0)))
+        except GsmModemException as e :
+            logging.debug(f'command_with_retry: {at_command} [{attempt}] -> {e!r}')
+            last_attempt = attempt == retries - 1
+            if isinstance(e, TimeoutException) :
+                # réponse tardive : jetée pour ne pas la lire comme celle du prochain essai
+                bt_client.drain()
+            if not e.retryable or last_attempt or time.monotonic() - start + delay >= deadline :
+                raise
+        time.sleep(delay)
+        delay *= 2
+
+# ----------------------------------------------------------
+
+def run_job(bt_client, job) :
+    # exécute d'une traite, sur la même connexion, une tâche prévue pour CommandScheduler
+    try :
+        next(job)
+        while True :
+            job.send(bt_client)
+    except StopIteration as e :
+        return e.value
+
+# ----------------------------------------------------------
+
+def open_client(service) :
+    # service : tuple (addr, port), ou BTClient déjà connecté (session)
+    if isinstance(service, BTClient) :
+        return contextlib.nullcontext(service)
+    return BTClient(service)
+
+def service_addr(service) :
+    return service.service[0] if isinstance(service, BTClient) else service[0]
+
+# ----------------------------------------------------------
+
 def at_cmd(service, cmd, wait=1, bufsize=32) :
     response = b''
 
-    with BTClient(service) as bt_client :
+    with open_client(service) as bt_client :
         response = bt_client.send(cmd, wait=wait, bufsize=bufsize)
     
     return response
@@ -270,13 +582,28 @@ def ask(service, cmd, wait=1, bufsize=32) :
 
 def set_sms_mode(bt_client, mode=SMSFormat.PDU) :
     mode = SMSFormat(mode)
+    # mode déjà sélectionné sur cette connexion
+    if bt_client.state.get('mode') == mode :
+        return b''
     response = bt_client.send(f'AT+CMGF={mode.value}', wait=1, bufsize=32)
+    if b'OK' in response :
+        bt_client.state['mode'] = mode
+    else :
+        bt_client.state.pop('mode', None)
     return response
 
 # ----------------------------------------------------------
 
 def set_sms_storage(bt_client, storage_1="SM", storage_2="SM", storage_3="SM") :
+    storage = (storage_1, storage_2, storage_3)
+    # storages déjà sélectionnés sur cette connexion
+    if bt_client.state.get('storage') == storage :
+        return b''
     response = bt_client.send(f'AT+CPMS="{storage_1}","{storage_2}","{storage_3}"', bufsize=32, wait=1)
+    if b'OK' in response :
+        bt_client.state['storage'] = storage
+    else :
+        bt_client.state.pop('storage', None)
     return response
 
 # ----------------------------------------------------------
@@ -284,7 +611,7 @@ def set_sms_storage(bt_client, storage_1="SM", storage_2="SM", storage_3="SM") :
 def get_smsc(service) :
     response = b''
 
-    with BTClient(service) as bt_client :
+    with open_client(service) as bt_client :
         response = bt_client.send('AT+CSCA?', wait=2, bufsize=64)
 
     return response
@@ -294,7 +621,7 @@ def get_smsc(service) :
 def send_sms(service, numero, message) :
     response = b''
 
-    with BTClient(service) as bt_client :
+    with open_client(service) as bt_client :
         # passer en mode texte
         set_sms_mode(bt_client, mode=SMSFormat.TEXT)
 
@@ -309,7 +636,7 @@ def send_sms(service, numero, message) :
 
 # ----------------------------------------------------------
 
-def send_sms_pdu(service, numero, message) :
+def send_sms_pdu(service, numero, message, timeout=30) :
 
     responses = []
 
@@ -320,25 +647,44 @@ def send_sms_pdu(service, numero, message) :
         requestStatusReport=False
     )
     
-    with BTClient(service) as bt_client :
+    with open_client(service) as bt_client :
         # s'assurer du mode binaire PDU
         set_sms_mode(bt_client, SMSFormat.PDU)
 
         # envoi du sms par morceaux
         for _sms in smspdu :
-            bt_client.send(f'AT+CMGS={_sms.tpduLength}', wait=2, bufsize=16)
-            response = bt_client.send(f'{_sms}{chr(0x1a)}', wait=2, bufsize=16)
+            written = False
+            try :
+                # +CMS ERROR dès l'invite : erreur typée, le PDU n'est pas envoyé
+                bt_client.prompt(f'AT+CMGS={_sms.tpduLength}', bufsize=16)
+                written = True
+                # +CMS ERROR : exception immédiate, sans attendre les morceaux suivants
+                response = bt_client.command(f'{_sms}{chr(0x1a)}', timeout=timeout, bufsize=16)
+            except (OSError, GsmModemException) as e :
+                # nombre de morceaux déjà acceptés par le modem
+                e.accepted = len(responses)
+                # PDU écrit sans réponse (délai, connexion perdue) : peut-être transmis
+                e.uncertain = e.accepted > 0 or (
+                    written and isinstance(e, (OSError, TimeoutException))
+                )
+                raise
             responses.append(response.decode())
 
     return responses
 
 # ----------------------------------------------------------
 
+def count_parts(numero, message) :
+    # nombre de SMS nécessaires pour transmettre le message
+    return len(encodeSmsSubmitPdu(number=numero, text=message, requestStatusReport=False))
+
+# ----------------------------------------------------------
+
 def get_sms(service, index, wait=3, encoding='utf-8', storage="SM") :
 
     response = b''
 
-    with BTClient(service) as bt_client :
+    with open_client(service) as bt_client :
         # passer en mode binaire PDU
         set_sms_mode(bt_client, SMSFormat.PDU)
 
@@ -368,11 +714,45 @@ def get_sms(service, index, wait=3, encoding='utf-8', storage="SM") :
 
 # ----------------------------------------------------------
 
+def read_slot_pdu(bt_client, index, timeout=10) :
+    # mode PDU et storage déjà sélectionnés
+    try :
+        response = bt_client.command(f'AT+CMGR={index}', timeout=timeout, bufsize=64)
+    except CmsError as e :
+        # invalid memory index : slot vide
+        if e.code == 321 :
+            return []
+        raise
+    records = re.findall(b'\\+CMGR: ?([0-9]+),.*\r\n([0-9A-Fa-f]+)\r\n', response)
+    # slot vide : pas d'enregistrement
+    return [(index, int(filter_type), pdu.decode()) for filter_type, pdu in records]
+
+# ----------------------------------------------------------
+
+def read_slots_pdu(service, indexes, timeout=10, storage="SM") :
+
+    with open_client(service) as bt_client :
+        # s'assurer du mode binaire PDU
+        set_sms_mode(bt_client, SMSFormat.PDU)
+
+        # sélectionner le storage "SM" ou "ME"
+        set_sms_storage(bt_client, storage_1=storage)
+
+        try :
+            for index in indexes :
+                yield from read_slot_pdu(bt_client, index, timeout=timeout)
+        finally :
+            # revenir au storage "SM"
+            if storage != "SM" :
+                set_sms_storage(bt_client, storage_1="SM")
+
+# ----------------------------------------------------------
+
 def store_sms(service, numero, message, storage="SM", filter_by=SMSFilter.STO_UNSENT) :
 
     response = b''
 
-    with BTClient(service) as bt_client :
+    with open_client(service) as bt_client :
         # passer en mode texte
         set_sms_mode(bt_client, SMSFormat.TEXT)
 
@@ -402,7 +782,7 @@ def send_from_storage(service, index, numero=None, storage="SM") :
 
     response = b''
 
-    with BTClient(service) as bt_client :
+    with open_client(service) as bt_client :
         # passer en mode texte
         set_sms_mode(bt_client, SMSFormat.TEXT)
 
@@ -430,11 +810,73 @@ def send_from_storage(service, index, numero=None, storage="SM") :
 
 # ----------------------------------------------------------
 
+def send_to_many(service, recipients, message, storage="SM", cleanup=True, timeout=30) :
+
+    results = { numero : [] for numero in recipients }
+    if len(results) == 0 :
+        return results
+
+    # composition du SMS (le destinataire sera remplacé par AT+CMSS)
+    smspdu = encodeSmsSubmitPdu(
+        number=recipients[0],
+        text=message,
+        requestStatusReport=False
+    )
+
+    with open_client(service) as bt_client :
+        # s'assurer du mode binaire PDU
+        set_sms_mode(bt_client, SMSFormat.PDU)
+
+        # sélectionner le storage "SM" ou "ME" (écriture, et suppression finale)
+        set_sms_storage(bt_client, storage_1=storage, storage_2=storage)
+
+        # stockage unique du message, par morceaux
+        # un échec de stockage est levé : aucun envoi n'a eu lieu
+        indexes = []
+        try :
+            for _sms in smspdu :
+                bt_client.prompt(f'AT+CMGW={_sms.tpduLength},{SMSFilter.STO_UNSENT.value}', timeout=timeout)
+                response = bt_client.command(f'{_sms}{chr(0x1a)}', timeout=timeout)
+                slot = re.findall(rb'\+CMGW: ?([0-9]+)', response)
+                if len(slot) == 0 :
+                    logging.debug(f'send_to_many: store failed -> {response}')
+                    raise CommandError('AT+CMGW')
+                indexes.append(int(slot[0]))
+
+            # envoi depuis le storage vers chaque destinataire
+            for numero in recipients :
+                numtype = 145 if numero.startswith('+') else 129
+                for index in indexes :
+                    try :
+                        response = bt_client.command(f'AT+CMSS={index},"{numero}",{numtype}', timeout=timeout)
+                        results[numero].append(response.decode())
+                    except GsmModemException as e :
+                        # échec pour ce destinataire : on passe au suivant
+                        results[numero].append(e)
+                        break
+
+        finally :
+            # libérer les slots utilisés, même après une erreur ;
+            # un échec ici ne doit pas masquer l'erreur d'origine
+            try :
+                if cleanup :
+                    for index in indexes :
+                        bt_client.command(f'AT+CMGD={index}', timeout=timeout, check=False)
+
+                # revenir au storage "SM"
+                set_sms_storage(bt_client)
+            except (OSError, GsmModemException) as e :
+                logging.debug(f'send_to_many: cleanup failed {indexes} -> {e!r}')
+
+    return results
+
+# ----------------------------------------------------------
+
 def delete_sms(service, index, storage="SM") :
 
     response = b''
 
-    with BTClient(service) as bt_client :
+    with open_client(service) as bt_client :
         # sélectionner le storage "SM" ou "ME"
         if storage == "ME" :
             set_sms_storage(bt_client, storage_1=storage)
@@ -452,26 +894,98 @@ def delete_sms(service, index, storage="SM") :
 
 # ----------------------------------------------------------
 
-def get_all_sms(service, retries=10, storage="SM", filter_by=SMSFilter.ALL) :
+def delete_sms_list(service, indexes, storage="SM") :
+
+    responses = dict()
+
+    with open_client(service) as bt_client :
+        # sélectionner le storage "SM" ou "ME"
+        set_sms_storage(bt_client, storage_1=storage)
+
+        # suppressions à la suite sur la même connexion
+        for index in indexes :
+            responses[index] = bt_client.send(f'AT+CMGD={index}', wait=1)
+
+        # revenir au storage "SM"
+        set_sms_storage(bt_client, storage_1="SM")
+
+    return responses
+
+# ----------------------------------------------------------
+
+def delete_sms_job(bt_client, indexes, storage="SM") :
+
+    # tâche pour CommandScheduler : rend la main après chaque suppression
+    responses = dict()
+
+    for index in indexes :
+        # le storage a pu être changé par une autre tâche entre-temps
+        set_sms_storage(bt_client, storage_1=storage)
+        responses[index] = bt_client.command(f'AT+CMGD={index}', check=False)
+        bt_client = yield
+
+    # revenir au storage "SM"
+    set_sms_storage(bt_client, storage_1="SM")
+
+    return responses
+
+# ----------------------------------------------------------
+
+def delete_flags(service) :
+
+    with open_client(service) as bt_client :
+        if 'delete_flags' not in bt_client.state :
+            # +CMGD: (1-30),(0-4)
+            response = bt_client.send('AT+CMGD=?', wait=1, bufsize=32)
+            ranges = re.findall(b'\\(([0-9]+)-([0-9]+)\\)', response)
+            flags = set()
+            if len(ranges) >= 2 :
+                first, last = ranges[1]
+                flags = {
+                    SMSDeleteFlag(flag)
+                    for flag in range(int(first), int(last) + 1)
+                    if flag < len(SMSDeleteFlag)
+                }
+            bt_client.state['delete_flags'] = flags
+
+    return bt_client.state['delete_flags']
+
+# ----------------------------------------------------------
+
+def delete_sms_flag(service, flag, storage="SM") :
+
+    flag = SMSDeleteFlag(flag)
+
+    with open_client(service) as bt_client :
+        # sélectionner le storage "SM" ou "ME"
+        set_sms_storage(bt_client, storage_1=storage)
+
+        # suppression groupée : l'index est ignoré par le téléphone
+        response = bt_client.send(f'AT+CMGD=1,{flag.value}', wait=3, bufsize=32)
+
+        # revenir au storage "SM"
+        set_sms_storage(bt_client, storage_1="SM")
+
+    return response
+
+# ----------------------------------------------------------
+
+def get_all_sms(service, retries=10, storage="SM", filter_by=SMSFilter.ALL, deadline=30) :
 
     data = b''
     
-    with BTClient(service) as bt_client :        
+    with open_client(service) as bt_client :        
         # passer en mode texte
         set_sms_mode(bt_client, SMSFormat.TEXT)
 
         # sélectionner le storage "SM" ou "ME"
-        if storage == "ME" :
-            set_sms_storage(bt_client, storage_1=storage)
-        else :
-            set_sms_storage(bt_client, storage_1="SM")
+        set_sms_storage(bt_client, storage_1=storage)
 
-        for r in range(retries) :
-            response = bt_client.send(f'AT+CMGL="{filter_by.label}"', wait=3, bufsize=64)
-            indexes = re.findall(b'\\+CMGL:([0-9]+)', response)
-            if len(indexes) > 0 :
-                data = response
-                break
+        response = command_with_retry(
+            bt_client, f'AT+CMGL="{filter_by.label}"', retries=retries, deadline=deadline
+        )
+        if RE_CMGL.search(response) is not None :
+            data = response
 
         # revenir en mode binaire PDU
         set_sms_mode(bt_client)
@@ -483,26 +997,22 @@ def get_all_sms(service, retries=10, storage="SM", filter_by=SMSFilter.ALL) :
 
 # ----------------------------------------------------------
 
-def get_all_sms_pdu(service, retries=20, storage="SM", filter_by=SMSFilter.ALL) :
+def get_all_sms_pdu(service, retries=20, storage="SM", filter_by=SMSFilter.ALL, deadline=30) :
 
     data = b''
     
-    with BTClient(service) as bt_client :        
+    with open_client(service) as bt_client :        
         # s'assurer du mode binaire PDU
         set_sms_mode(bt_client, SMSFormat.PDU)
 
         # sélectionner le storage "SM" ou "ME"
-        if storage == "ME" :
-            set_sms_storage(bt_client, storage_1=storage)
-        else :
-            set_sms_storage(bt_client, storage_1="SM")
+        set_sms_storage(bt_client, storage_1=storage)
 
-        for r in range(retries) :
-            response = bt_client.send(f'AT+CMGL={filter_by}', wait=2, bufsize=64)
-            indexes = re.findall(b'\\+CMGL:([0-9]+)', response)
-            if len(indexes) > 0 :
-                data = response
-                break
+        response = command_with_retry(
+            bt_client, f'AT+CMGL={filter_by}', retries=retries, deadline=deadline
+        )
+        if RE_CMGL.search(response) is not None :
+            data = response
 
         # revenir au storage "SM"
         set_sms_storage(bt_client, storage_1="SM")
@@ -0,0 +1,204 @@
+# -*- encoding: utf-8 -*-
+
+__all__ = [
+    'MessageStore',
+]
+
+import time
+import hashlib
+import sqlite3
+import threading
+from datetime import datetime
+
+from .sms import SMSFilter
+
+# Stockage local des SMS lus depuis le téléphone
+
+# ----------------------------------------------------------
+
+STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    storage     TEXT NOT NULL,
+    slot        INTEGER NOT NULL,
+    hash        TEXT NOT NULL,
+    filter_type INTEGER NOT NULL,
+    type        TEXT,
+    number      TEXT,
+    time        TEXT,
+    text        TEXT,
+    reference   INTEGER,
+    part        INTEGER,
+    parts       INTEGER NOT NULL DEFAULT 1,
+    smsc        TEXT,
+    pdu         TEXT NOT NULL,
+    synced      REAL NOT NULL,
+    PRIMARY KEY (storage, slot, hash)
+);
+CREATE TABLE IF NOT EXISTS sync_state (
+    storage     TEXT PRIMARY KEY,
+    count       INTEGER NOT NULL,
+    total       INTEGER NOT NULL,
+    synced      REAL NOT NULL
+);
+"""
+
+def pdu_hash(pdu) :
+    return hashlib.sha1(pdu.encode()).hexdigest()
+
+# ----------------------------------------------------------
+
+class MessageStore :
+
+    def __init__(self, path='messages.db') :
+        self._path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._db.row_factory = sqlite3.Row
+        with self._lock :
+            self._db.executescript(STORE_SCHEMA)
+
+    @property
+    def path(self) :
+        return self._path
+
+    def counts(self, storage) :
+        with self._lock :
+            row = self._db.execute(
+                'SELECT count, total FROM sync_state WHERE storage=?', (storage,)
+            ).fetchone()
+        return None if row is None else (row['count'], row['total'])
+
+    def set_counts(self, storage, count, total) :
+        with self._lock :
+            self._db.execute(
+                'INSERT OR REPLACE INTO sync_state (storage, count, total, synced) '
+                'VALUES (?, ?, ?, ?)',
+                (storage, count, total, time.time())
+            )
+
+    def _insert(self, storage, records, now) :
+        self._db.executemany(
+            'INSERT OR REPLACE INTO messages '
+            '(storage, slot, hash, filter_type, type, number, time, text, '
+            'reference, part, parts, smsc, pdu, synced) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [
+                (
+                    storage, r['slot'], pdu_hash(r['pdu']), int(r['filter_type']),
+                    r.get('type'), r.get('number'),
+                    None if r.get('time') is None else r['time'].isoformat(),
+                    r.get('text'), r.get('reference'), r.get('part'), r.get('parts', 1),
+                    r.get('smsc'), r['pdu'], now
+                )
+                for r in records
+            ]
+        )
+
+    def replace(self, storage, records, counts=None) :
+        # remplace tout le contenu d'un storage par les enregistrements lus
+        now = time.time()
+        with self._lock :
+            self._db.execute('BEGIN')
+            try :
+                self._db.execute('DELETE FROM messages WHERE storage=?', (storage,))
+                self._insert(storage, records, now)
+                if counts is not None :
+                    self._db.execute(
+                        'INSERT OR REPLACE INTO sync_state (storage, count, total, synced) '
+                        'VALUES (?, ?, ?, ?)',
+                        (storage, *counts, now)
+                    )
+                self._db.execute('COMMIT')
+            except Exception :
+                self._db.execute('ROLLBACK')
+                raise
+
+    def update(self, storage, records, counts=None) :
+        # ajoute les enregistrements lus, en remplaçant les slots déjà connus
+        now = time.time()
+        with self._lock :
+            self._db.execute('BEGIN')
+            try :
+                self._db.executemany(
+                    'DELETE FROM messages WHERE storage=? AND slot=?',
+                    [(storage, r['slot']) for r in records]
+                )
+                self._insert(storage, records, now)
+                if counts is not None :
+                    self._db.execute(
+                        'INSERT OR REPLACE INTO sync_state (storage, count, total, synced) '
+                        'VALUES (?, ?, ?, ?)',
+                        (storage, *counts, now)
+                    )
+                self._db.execute('COMMIT')
+            except Exception :
+                self._db.execute('ROLLBACK')
+                raise
+
+    def delete(self, storage, slots) :
+        # messages supprimés du téléphone : les compteurs suivent
+        with self._lock :
+            self._db.executemany(
+                'DELETE FROM messages WHERE storage=? AND slot=?',
+                [(storage, slot) for slot in slots]
+            )
+            self._db.execute(
+                'UPDATE sync_state SET count=MAX(count-?, 0) WHERE storage=?',
+                (len(slots), storage)
+            )
+
+    def delete_filters(self, storage, filters) :
+        with self._lock :
+            slots = [
+                row['slot']
+                for row in self._db.execute(
+                    'SELECT DISTINCT slot FROM messages WHERE storage=? AND filter_type IN ({})'.format(
+                        ','.join('?' * len(filters))
+                    ),
+                    (storage, *[int(f) for f in filters])
+                )
+            ]
+        self.delete(storage, slots)
+
+    def slots(self, storage) :
+        with self._lock :
+            rows = self._db.execute(
+                'SELECT slot, hash FROM messages WHERE storage=?', (storage,)
+            ).fetchall()
+        return { row['slot'] : row['hash'] for row in rows }
+
+    def records(self, storage, filter_by=SMSFilter.ALL) :
+        query = 'SELECT * FROM messages WHERE storage=?'
+        params = [storage]
+        if filter_by != SMSFilter.ALL :
+            query += ' AND filter_type=?'
+            params.append(int(filter_by))
+        query += ' ORDER BY slot'
+
+        with self._lock :
+            rows = self._db.execute(query, params).fetchall()
+
+        return [self._record(row) for row in rows]
+
+    @staticmethod
+    def _record(row) :
+        record = dict(row)
+        record['filter_type'] = SMSFilter(record['filter_type'])
+        if record['time'] is not None :
+            record['time'] = datetime.fromisoformat(record['time'])
+        record['validity'] = None
+        del record['storage'], record['synced']
+        return record
+
+    def clear(self, storage=None) :
+        with self._lock :
+            if storage is None :
+                self._db.execute('DELETE FROM messages')
+                self._db.execute('DELETE FROM sync_state')
+            else :
+                self._db.execute('DELETE FROM messages WHERE storage=?', (storage,))
+                self._db.execute('DELETE FROM sync_state WHERE storage=?', (storage,))
+
+    def close(self) :
+        with self._lock :
+            self._db.close()
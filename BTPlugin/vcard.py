@@ -0,0 +1,136 @@
+# -*- encoding: utf-8 -*-
+
+__all__ = [
+    'VCard',
+    'read_vcards',
+    'write_vcards',
+    'vcard_entries',
+]
+
+import re
+import quopri
+from collections import namedtuple
+
+from .phonebook import PhoneBookEntry
+
+# Lecture / écriture de carnets d'adresses au format vCard (2.1 et 3.0)
+
+# ----------------------------------------------------------
+
+# une carte : nom affiché, [(numéro, types)], propriétés brutes
+VCard = namedtuple('VCard', ['name', 'numbers', 'properties'])
+
+RE_PROPERTY = re.compile(r'^([^:;]+)((?:;[^:]*)?):(.*)$')
+
+def unescape(value) :
+    return re.sub(
+        r'\\(.)',
+        lambda m : '\n' if m.group(1) in 'nN' else m.group(1),
+        value
+    )
+
+def escape(value) :
+    return (
+        value.replace('\\', '\\\\').replace(';', '\\;')
+        .replace(',', '\\,').replace('\n', '\\n')
+    )
+
+def parse_params(params) :
+    # ";TYPE=CELL;ENCODING=QUOTED-PRINTABLE" ou ";CELL;VOICE" (2.1)
+    values = dict()
+    types = []
+    for param in params.split(';') :
+        if param == '' :
+            continue
+        key, sep, value = param.partition('=')
+        if sep == '' :
+            types.append(key.upper())
+        elif key.upper() == 'TYPE' :
+            types.extend(v.upper() for v in value.split(','))
+        else :
+            values[key.upper()] = value
+    return values, types
+
+def decode_value(value, params) :
+    if params.get('ENCODING', '').upper() in ('QUOTED-PRINTABLE', 'QP') :
+        charset = params.get('CHARSET', 'utf-8')
+        return quopri.decodestring(value.encode()).decode(charset, errors='replace')
+    return unescape(value)
+
+def is_quoted_printable(line) :
+    return 'QUOTED-PRINTABLE' in line.split(':', 1)[0].upper()
+
+def unfold(lines) :
+    # lignes logiques : repli par espace (3.0) ou '=' final en quoted-printable (2.1)
+    current = None
+    for line in lines :
+        if isinstance(line, bytes) :
+            line = line.decode('utf-8', errors='replace')
+        line = line.rstrip('\r\n')
+        if current is not None and current.endswith('=') and is_quoted_printable(current) :
+            current = current[:-1] + line
+            continue
+        if current is not None and line[:1] in (' ', '\t') :
+            current += line[1:]
+            continue
+        if current is not None :
+            yield current
+        current = line
+    if current is not None :
+        yield current
+
+def read_vcards(lines) :
+    # générateur : une VCard par carte lue, sans charger tout le fichier
+    card = None
+    for line in unfold(lines) :
+        match = RE_PROPERTY.match(line)
+        if match is None :
+            continue
+        name, params, value = match.groups()
+        name = name.split('.')[-1].upper()
+
+        if name == 'BEGIN' and value.upper() == 'VCARD' :
+            card = { 'FN' : None, 'N' : None, 'numbers' : [], 'properties' : [] }
+            continue
+        if card is None :
+            continue
+        if name == 'END' and value.upper() == 'VCARD' :
+            label = card['FN'] or ' '.join(
+                part for part in reversed((card['N'] or '').split(';')[:2]) if part
+            )
+            yield VCard(label, card['numbers'], card['properties'])
+            card = None
+            continue
+
+        params, types = parse_params(params)
+        value = decode_value(value, params)
+        if name in ('FN', 'N') :
+            card[name] = value
+        elif name == 'TEL' :
+            card['numbers'].append((value.strip(), types))
+        card['properties'].append((name, value))
+
+def vcard_entries(cards, indexed=False) :
+    # une entrée du phonebook par numéro : AT+CPBW n'en stocke qu'un
+    # indexed : index "carte.numéro", unique par numéro (rang de la carte dans
+    # les listings PBAP, 0 = propriétaire) ; ce n'est pas un emplacement AT+CPBW
+    for position, card in enumerate(cards) :
+        for rank, (number, types) in enumerate(card.numbers) :
+            number = re.sub(r'[^0-9+*#pw]', '', number)
+            if number == '' :
+                continue
+            index = f'{position}.{rank}' if indexed else None
+            numtype = 145 if number.startswith('+') else 129
+            yield PhoneBookEntry(index, number, numtype, card.name, None)
+
+def write_vcards(entries, file) :
+    for entry in entries :
+        label = entry.label or ''
+        file.write(
+            'BEGIN:VCARD\r\n'
+            'VERSION:3.0\r\n'
+            f'FN:{escape(label)}\r\n'
+            f'N:{escape(label)};;;;\r\n'
+            f'TEL;TYPE=CELL:{entry.number}\r\n'
+            'END:VCARD\r\n'
+        )
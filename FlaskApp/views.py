@@ -4,20 +4,110 @@ Routes and views for the flask application.
 
 from datetime import datetime
 from os import environ
+import threading
+import contextlib
 
-from BTPlugin import list_devices, BTNearbyDevices, BTClient, sms
+from BTPlugin import list_devices
+from BTPlugin.exceptions import GsmModemException
+from BTPlugin.outbox import Outbox
+from BTPlugin.store import MessageStore
+from BTPlugin.scheduler import Priority
+from BTPlugin.sms import SMS
+from BTPlugin.phonebook import PhoneBookEntry
+from BTPlugin.contacts import ContactCache, ContactIndex, storage_used
+from BTPlugin.broker import Broker, BrokerClient, build_pool
+from BTPlugin.obex import ObexSessionPool, ObexError
 
 from markupsafe import Markup
 from flask import (
     request, redirect, url_for,
-    render_template, send_file
+    render_template, send_file,
+    jsonify, abort,
+    Response, stream_with_context
 )
 from . import forms
 from . import app
 
-nearby = BTNearbyDevices()
 BT_PHONE = environ.get('BT_PHONE', '<NO_PHONE>')
 
+outbox = Outbox(
+    environ.get('SMS_OUTBOX', 'outbox.db'),
+    recover='BT_BROKER' not in environ
+)
+message_store = MessageStore(environ.get('SMS_STORE', 'messages.db'))
+inbox_sync = None
+contacts = ContactCache(country=environ.get('SMS_COUNTRY', '33'))
+# storage du cache rempli par PBAP (phonebook complet du téléphone)
+PBAP_STORAGE = 'PB'
+# chaque noeud du trie garde assez d'entrées pour le plus grand k accepté
+COMPLETE_MAX = 50
+contact_index = ContactIndex(contacts, k=COMPLETE_MAX)
+contact_index.start()
+
+if 'BT_BROKER' in environ :
+    # les téléphones appartiennent au broker (python -m BTPlugin.broker)
+    modem = BrokerClient(environ['BT_BROKER'])
+else :
+    phone_pool = build_pool(outbox)
+    phone_pool.start()
+    modem = Broker(phone_pool, message_store)
+
+def sync_inbox(storage) :
+    # la synchronisation passe après les envois en attente sur ce téléphone
+    try :
+        modem.call('SMS.syncMessages', storage=storage, priority=Priority.SYNC)
+    except (OSError, GsmModemException) as e :
+        app.logger.warning(f'sync_inbox: {storage} -> {e!r}')
+    refresh_contacts()
+
+def refresh_contacts(storages=('SM', 'ME'), force=False) :
+    # relit le phonebook seulement si le nombre d'entrées d'un storage a changé
+    used = dict()
+    for storage in storages :
+        try :
+            used[storage] = storage_used(
+                modem.call('phonebook.pbStorage', storage=storage, priority=Priority.SYNC)
+            )
+        except (OSError, GsmModemException) as e :
+            app.logger.warning(f'refresh_contacts: {storage} -> {e!r}')
+            used[storage] = None
+
+    # tout le phonebook en un transfert PBAP, au lieu d'un AT+CPBR par page
+    counts = tuple(used[storage] for storage in storages)
+    if not force and None not in counts and (
+        contacts.fresh(PBAP_STORAGE, counts)
+        or all(contacts.fresh(storage, used[storage]) for storage in storages)
+    ) :
+        return
+    try :
+        entries = modem.call('pbap.entries', counts=None if None in counts else counts, force=force)
+    except (OSError, GsmModemException) as e :
+        app.logger.info(f'refresh_contacts: PBAP unavailable -> {e!r}')
+    else :
+        contacts.load(PBAP_STORAGE, [PhoneBookEntry(*entry) for entry in entries], counts)
+        return
+
+    # sinon lecture AT+CPBR des storages modifiés
+    for storage in storages :
+        if not force and used[storage] is not None and contacts.fresh(storage, used[storage]) :
+            continue
+        try :
+            entries = modem.call(
+                'phonebook.pbRead', stop_index=-1, storage=storage, priority=Priority.SYNC
+            )
+        except (OSError, GsmModemException) as e :
+            app.logger.warning(f'refresh_contacts: {storage} -> {e!r}')
+            continue
+        contacts.load(storage, [PhoneBookEntry(*entry) for entry in entries], used[storage])
+
+# sessions OBEX FTP gardées ouvertes entre deux pages du navigateur de fichiers,
+# fermées après OBEX_IDLE secondes d'inactivité
+obex_sessions = ObexSessionPool(idle=int(environ.get('OBEX_IDLE', '60')))
+obex_sessions.start()
+
+# premier chargement du phonebook pour l'autocomplétion
+threading.Thread(target=refresh_contacts, daemon=True).start()
+
 @app.route('/')
 @app.route('/home')
 def home():
@@ -65,20 +155,17 @@ def sendsms() :
     form = forms.SendSMSForm(request.form)
 
     if request.method == 'POST' and form.validate() :
-        try :
-            feedback = sms.send_sms_pdu(
-                nearby.service_dialup(BT_PHONE),
-                numero=form.phoneno.data,
-                message=form.textsms.data
-            )   
-        except OSError :
-            feedback = 'Autorisation refusée'
+        msg_id = outbox.enqueue(
+            numero=form.phoneno.data,
+            message=form.textsms.data
+        )
 
         return render_template(
             'smssent.html',
-            title='SMS Envoyé',
+            title='SMS en attente',
             year=datetime.now().year,
-            message=feedback
+            message=f'SMS n°{msg_id} placé en file d\'envoi',
+            msg_id=msg_id
         )
 
     return render_template(
@@ -87,3 +174,128 @@ def sendsms() :
         year=datetime.now().year,
         form=form
     )
+
+@app.route('/contacts/complete')
+def contacts_complete() :
+    """Returns the contacts matching the beginning of a name or number"""
+    prefix = request.args.get('q', '')
+    k = max(1, min(request.args.get('k', 10, type=int), COMPLETE_MAX))
+    return jsonify([
+        { 'label' : entry.label, 'number' : entry.number }
+        for entry in contact_index.complete(prefix, k)
+    ])
+
+@app.route('/files/', methods=['GET', 'POST'])
+@app.route('/files/<path:path>', methods=['GET', 'POST'])
+def files(path='') :
+    """Renders the phone file system"""
+    path = path.strip('/')
+    try :
+        with obex_sessions.session(BT_PHONE) as browser :
+            upload = request.files.get('file')
+            if request.method == 'POST' and upload is not None and upload.filename != '' :
+                if not browser.cd(path) :
+                    abort(404)
+                # envoi bloc par bloc depuis le fichier temporaire de l'upload
+                size = upload.stream.seek(0, 2)
+                upload.stream.seek(0)
+                browser.put_stream(upload.filename, upload.stream, size)
+            # listing en cache : pas de setpath tant que le dossier n'a pas changé
+            entries = browser.listing(path, refresh='refresh' in request.args)
+        error = None if entries is not None else 'failed to list directory'
+    except OSError as e :
+        app.logger.warning(f'files: {path} -> {e!r}')
+        entries, error = None, str(e)
+
+    return render_template(
+        'files.html',
+        title='Fichiers',
+        year=datetime.now().year,
+        path=path,
+        parent=path.rpartition('/')[0],
+        entries=entries or [],
+        error=error
+    )
+
+@app.route('/files/download/<path:path>')
+def files_download(path) :
+    """Streams a file of the phone to the browser"""
+    folder, _, name = path.rpartition('/')
+
+    # la session reste réservée du choix du dossier à la fin du transfert
+    session = contextlib.ExitStack()
+    try :
+        with session :
+            browser = session.enter_context(obex_sessions.session(BT_PHONE))
+            if not browser.cd(folder) :
+                abort(404)
+            session = session.pop_all()
+    except OSError as e :
+        app.logger.warning(f'files_download: {path} -> {e!r}')
+        abort(503)
+
+    def stream() :
+        with session :
+            try :
+                yield from browser.iter_get(name)
+            except ObexError as e :
+                app.logger.warning(f'files_download: {path} -> {e}')
+
+    response = Response(
+        stream_with_context(stream()),
+        mimetype='application/octet-stream',
+        headers={ 'Content-Disposition' : f'attachment; filename="{name}"' }
+    )
+    # transfert jamais commencé (client parti) : libérer la session quand même
+    response.call_on_close(session.close)
+    return response
+
+@app.route('/outbox')
+def outbox_list() :
+    """Renders the outbox page"""
+    try :
+        stats = modem.call('pool.stats')
+    except OSError as e :
+        app.logger.warning(f'outbox_list: {e!r}')
+        stats = { 'phones' : [], 'rates' : { 'phones' : dict(), 'prefixes' : dict() } }
+
+    return render_template(
+        'outbox.html',
+        title='File d\'envoi',
+        year=datetime.now().year,
+        messages=outbox.list(),
+        phones=stats['phones'],
+        rates=stats['rates'],
+        waits=outbox.wait_stats()
+    )
+
+@app.route('/outbox/<int:msg_id>')
+def outbox_status(msg_id) :
+    """Returns the status of a queued SMS"""
+    record = outbox.get(msg_id)
+    if record is None :
+        abort(404)
+    return jsonify(record)
+
+@app.route('/inbox')
+@app.route('/inbox/<storage>')
+def inbox(storage='SM') :
+    """Renders the messages read from the phone"""
+    inbox = SMS(None, store=message_store)
+    return render_template(
+        'inbox.html',
+        title='Messages',
+        year=datetime.now().year,
+        storage=storage,
+        messages=contacts.decorate(inbox.storedMessages(storage=storage)),
+        syncing=inbox_sync is not None and inbox_sync.is_alive()
+    )
+
+@app.route('/inbox/<storage>/sync', methods=['POST'])
+def inbox_sync_start(storage) :
+    """Starts a background synchronisation of the phone messages"""
+    global inbox_sync
+    if inbox_sync is None or not inbox_sync.is_alive() :
+        inbox_sync = threading.Thread(target=sync_inbox, args=(storage,), daemon=True)
+        inbox_sync.start()
+    return redirect(url_for('inbox', storage=storage))